@@ -1,21 +1,58 @@
 #!/usr/bin/env python
 
+import fastq
+
+
+def check_index(args, idx):
+    """ Check block boundaries using the sidecar index, touching the FASTQ
+        file only at block starts """
+    if idx.block_bytes != args.block_bytes:
+        raise RuntimeError('Index says block size is %d, expected %d' % (idx.block_bytes, args.block_bytes))
+    nblocks = idx.nblocks
+    if args.stop_after is not None:
+        nblocks = min(nblocks, (args.stop_after + args.reads_per_block - 1) // args.reads_per_block)
+    offsets, first_reads = idx.block_offsets(), idx.block_first_reads()
+    with open(args.fastq, 'rb') as fh:
+        for b in range(nblocks + 1):
+            if offsets[b] != b * args.block_bytes:
+                raise RuntimeError('Expected boundary %d, got %d at block %d' %
+                                   (b * args.block_bytes, offsets[b], b))
+            if idx.reads_per_block == 0:
+                # packed blocks: any # reads per block, but at least one
+                if b > 0 and first_reads[b] <= first_reads[b-1]:
+                    raise RuntimeError('Block %d has no reads' % (b - 1))
+            elif first_reads[b] != b * args.reads_per_block:
+                raise RuntimeError('Expected block %d to start at read %d, not %d' %
+                                   (b, b * args.reads_per_block, first_reads[b]))
+            if b == idx.nblocks:
+                break
+            fh.seek(max(0, offsets[b] - 1))
+            start = fh.read(2 if b > 0 else 1)
+            if start[-1:] != b'@' or (b > 0 and start[:1] != b'\n'):
+                raise RuntimeError('No record starts at boundary %d (block %d)' % (offsets[b], b))
+    if nblocks == idx.nblocks and idx.file_size() != idx.nblocks * args.block_bytes:
+        raise RuntimeError('File size %d is not a whole number of blocks' % idx.file_size())
+
 
 def go(args):
+    idx = None if args.full_scan else fastq.open_index(args.fastq)
+    if idx is not None:
+        with idx:
+            check_index(args, idx)
+        print('PASSED')
+        return
     next_boundary = args.block_bytes
-    lines_per_block = args.reads_per_block * 4
-    with open(args.fastq, 'rb') as ifh:
-        i = 0
-        while True:
-            ln = ifh.readline()
-            if len(ln) == 0:
+    with fastq.FastqReader(args.fastq) as rdr:
+        nreads = 0
+        while args.stop_after is None or nreads < args.stop_after:
+            nskipped = rdr.skip_records(args.reads_per_block)
+            nreads += nskipped
+            if nskipped < args.reads_per_block:
                 break
-            i += 1
-            if i % lines_per_block == 0:
-                if ifh.tell() != next_boundary:
-                    raise RuntimeError('Expected boundary %d, got %d at line %d' %
-                                       (next_boundary, ifh.tell(), i))
-                next_boundary += args.block_bytes
+            if rdr.tell() != next_boundary:
+                raise RuntimeError('Expected boundary %d, got %d at line %d' %
+                                   (next_boundary, rdr.tell(), nreads * 4))
+            next_boundary += args.block_bytes
     print('PASSED')
 
 
@@ -32,4 +69,6 @@ if __name__ == '__main__':
                         help='# characters constituting a single fixed-size block of FASTQ input')
     parser.add_argument('--reads-per-block', metavar='int', type=int, default=70,
                         help='# reads in a single fixed-size block')
+    parser.add_argument('--full-scan', action='store_const', const=True, default=False,
+                        help='Scan the whole file even if it has a sidecar index')
     go(parser.parse_args())
@@ -0,0 +1,433 @@
+"""
+fastq.py
+
+Large-buffer FASTQ reading shared by reads.py, master.py and check_blocked.py.
+
+Input is decompressed (if gzipped) in big blocks and scanned with bytes
+methods that run at C speed, so whole batches of 4-line records can be
+skipped, copied or counted without creating a Python string per line.
+Decompression can optionally run in a background thread or in a `gzip -dc`
+subprocess so that it overlaps with the Python loop consuming the records.
+
+Also reads and writes the sidecar index (.fqi) of record and block offsets
+that reads.py writes next to its outputs.
+"""
+
+from __future__ import print_function
+import os
+import array
+import struct
+import shutil
+import gzip
+import subprocess
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+DECOMPRESS_MODES = ['inline', 'thread', 'subprocess']
+
+# _advance_lines counts newlines over windows that start at this many bytes
+# per line wanted and double up to COUNT_WINDOW, then bisects the last one
+COUNT_LINE_GUESS = 128
+COUNT_WINDOW = 64 * 1024
+
+
+class ThreadedReader(object):
+    """ File-like object whose read() returns blocks read from another file
+        object by a background thread, so that (for instance) zlib can
+        decompress the next block while the caller works on this one """
+
+    def __init__(self, fh, chunk_size, depth=4):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.q = queue.Queue(depth)
+        self.done = False
+        self.error = None
+        self.thread = threading.Thread(target=self._fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while True:
+                chunk = self.fh.read(self.chunk_size)
+                self.q.put(chunk)
+                if len(chunk) == 0:
+                    break
+        except Exception as e:
+            self.error = e
+            self.q.put(b'')
+
+    def read(self, n=-1):
+        if self.done:
+            return b''
+        chunk = self.q.get()
+        if len(chunk) == 0:
+            self.done = True
+            if self.error is not None:
+                raise self.error
+        return chunk
+
+    def close(self):
+        self.done = True
+        # unblock the filler thread if it is waiting on a full queue
+        while self.thread.is_alive():
+            try:
+                self.q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.fh.close()
+
+
+class SubprocessReader(object):
+    """ File-like object reading the output of a decompression subprocess """
+
+    def __init__(self, fn, chunk_size):
+        self.proc = subprocess.Popen(['gzip', '-dc', fn], stdout=subprocess.PIPE, bufsize=chunk_size)
+
+    def read(self, n=-1):
+        chunk = self.proc.stdout.read(n)
+        if len(chunk) == 0 and self.proc.wait() != 0:
+            raise RuntimeError('Exitlevel %d from "gzip -dc"' % self.proc.returncode)
+        return chunk
+
+    def close(self):
+        self.proc.stdout.close()
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+
+def open_raw(fn, decompress='inline', chunk_size=4 * 1024 * 1024):
+    """ Open a possibly-gzipped file for reading decompressed bytes """
+    if decompress not in DECOMPRESS_MODES:
+        raise RuntimeError('Unknown decompression mode: "%s"' % decompress)
+    if not fn.endswith('.gz'):
+        return open(fn, 'rb')
+    if decompress == 'subprocess':
+        return SubprocessReader(fn, chunk_size)
+    elif decompress == 'thread':
+        return ThreadedReader(gzip.open(fn, 'rb'), chunk_size)
+    return gzip.open(fn, 'rb')
+
+
+class FastqReader(object):
+    """ Buffered reader over a (possibly gzipped) FASTQ file.  Besides
+        readline(), can skip, copy or yield many 4-line records at once by
+        scanning large chunks for newlines.  tell() gives the offset into
+        the decompressed stream. """
+
+    def __init__(self, fn, decompress='inline', chunk_size=4 * 1024 * 1024):
+        self.fn = fn
+        self.fh = open_raw(fn, decompress=decompress, chunk_size=chunk_size)
+        self.chunk_size = chunk_size
+        self.buf = b''
+        self.pos = 0
+        self.base = 0  # offset of buf[0] in the decompressed stream
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+        self.fh = None
+
+    def tell(self):
+        return self.base + self.pos
+
+    def _next_chunk(self, keep_tail=False):
+        """ Read the next chunk into the buffer, optionally keeping the
+            unconsumed tail of the current buffer; False at end of file """
+        chunk = self.fh.read(self.chunk_size)
+        if len(chunk) == 0:
+            return False
+        if keep_tail and self.pos < len(self.buf):
+            self.base += self.pos
+            self.buf = self.buf[self.pos:] + chunk
+        else:
+            self.base += len(self.buf)
+            self.buf = chunk
+        self.pos = 0
+        return True
+
+    def readline(self):
+        i = self.buf.find(b'\n', self.pos)
+        while i < 0:
+            if not self._next_chunk(keep_tail=True):
+                ln = self.buf[self.pos:]
+                self.pos = len(self.buf)
+                return ln
+            i = self.buf.find(b'\n', self.pos)
+        ln = self.buf[self.pos:i+1]
+        self.pos = i + 1
+        return ln
+
+    def _advance_lines(self, nlines, ofh=None):
+        """ Move past nlines lines, writing them to ofh if given; returns #
+            lines not advanced over because end of file was reached """
+        while nlines > 0:
+            buf, lo = self.buf, self.pos
+            # count newlines a window at a time to find the window holding
+            # the end of the last line wanted
+            window = min(nlines * COUNT_LINE_GUESS, COUNT_WINDOW)
+            while lo < len(buf):
+                hi = min(lo + window, len(buf))
+                n = buf.count(b'\n', lo, hi)
+                if n >= nlines:
+                    break
+                nlines -= n
+                lo = hi
+                window = min(window * 2, COUNT_WINDOW)
+            else:
+                # a trailing partial line ends in the next chunk and is
+                # counted there, so the whole buffer can be consumed
+                if ofh is not None:
+                    ofh.write(memoryview(buf)[self.pos:])
+                self.pos = len(buf)
+                if not self._next_chunk():
+                    break
+                continue
+            # bisect the window for the newline ending the last line; the
+            # nlines-th newline from lo is always in [lo, hi)
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                n = buf.count(b'\n', lo, mid)
+                if n >= nlines:
+                    hi = mid
+                else:
+                    nlines -= n
+                    lo = mid
+            if ofh is not None:
+                ofh.write(memoryview(buf)[self.pos:lo+1])
+            self.pos = lo + 1
+            return 0
+        return nlines
+
+    def skip_records(self, n):
+        """ Pass over n records; returns # records skipped, which is less than
+            n only if end of file was reached """
+        return n - (self._advance_lines(n * 4) + 3) // 4
+
+    def copy_records(self, n, ofh):
+        """ Write the next n records to ofh; returns # records copied, which is
+            less than n only if end of file was reached """
+        return n - (self._advance_lines(n * 4, ofh) + 3) // 4
+
+    def batches(self):
+        """ Generator yielding (memoryview, # records) for runs of whole
+            records, one run per chunk.  A view is only valid until the next
+            one is requested. """
+        while True:
+            nl = self.buf.count(b'\n', self.pos)
+            nrec = nl // 4
+            if nrec > 0:
+                # end of the last whole record: skip back over the newlines
+                # of the trailing partial record
+                end = len(self.buf)
+                for _ in range(nl % 4 + 1):
+                    end = self.buf.rfind(b'\n', self.pos, end)
+                end += 1
+                yield memoryview(self.buf)[self.pos:end], nrec
+                self.pos = end
+            if not self._next_chunk(keep_tail=True):
+                break
+        if self.pos < len(self.buf):
+            raise RuntimeError('Partial record at end of "%s"' % self.fn)
+
+
+def count_lines(fn, decompress='inline', chunk_size=4 * 1024 * 1024):
+    """ Count newlines in a possibly-gzipped file """
+    fh = open_raw(fn, decompress=decompress, chunk_size=chunk_size)
+    try:
+        nlines = 0
+        while True:
+            chunk = fh.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            nlines += chunk.count(b'\n')
+        return nlines
+    finally:
+        fh.close()
+
+
+#
+# Sidecar index (<fastq>.fqi) giving byte offsets of every record and of
+# every block of a FASTQ file.  Layout, all little-endian:
+#
+#   header   8-byte magic, then uint64 nreads, nblocks, block_bytes
+#            (0 if blocks vary in size), reads_per_block (0 if it varies)
+#   uint64[nreads + 1]   offset of each record, then the file size
+#   uint64[nblocks + 1]  offset of each block, then the file size
+#   uint64[nblocks + 1]  index of the first record of each block, then nreads
+#
+# Individual entries can be read with a seek, so users don't need numpy.
+#
+
+INDEX_MAGIC = b'FQIDX001'
+INDEX_HEADER = struct.Struct('<8sQQQQ')
+
+
+def index_fn(fn):
+    """ Name of the sidecar index for FASTQ file fn """
+    return fn + '.fqi'
+
+
+class IndexWriter(object):
+    """ Builds the sidecar index for a FASTQ file as the file is written.
+        Record offsets and the block tables are streamed to temporary files
+        that close() stitches together.  state() describes a flushed writer
+        well enough for a new writer to pick up from it (resume=state). """
+
+    def __init__(self, fn, block_bytes=0, reads_per_block=0, flush_every=1 << 16, resume=None):
+        self.fn = fn
+        self.block_bytes = block_bytes
+        self.reads_per_block = reads_per_block
+        self.flush_every = flush_every
+        self.tmp_fns = [fn + '.tmp', fn + '.blocks.tmp', fn + '.firsts.tmp']
+        if resume is None:
+            self.fhs = [open(tmp_fn, 'wb') for tmp_fn in self.tmp_fns]
+            self.fhs[0].write(b'\0' * INDEX_HEADER.size)
+            self.offset = 0
+            self.nreads = 0
+            self.nblocks = 0
+            self.pending = [array.array('Q'), array.array('Q', [0]), array.array('Q', [0])]
+        else:
+            self.fhs = [open(tmp_fn, 'r+b') for tmp_fn in self.tmp_fns]
+            for fh, size in zip(self.fhs, resume['sizes']):
+                fh.truncate(size)
+                fh.seek(size)
+            self.offset = resume['offset']
+            self.nreads = resume['nreads']
+            self.nblocks = resume['nblocks']
+            self.pending = [array.array('Q'), array.array('Q'), array.array('Q')]
+
+    def add_block(self, lengths, pad=0):
+        """ Add a block made of records with the given lengths, where the last
+            record is followed by pad bytes of padding """
+        rec_offsets = self.pending[0]
+        for ln in lengths:
+            rec_offsets.append(self.offset)
+            self.offset += ln
+        self.offset += pad
+        self.nreads += len(lengths)
+        self.nblocks += 1
+        self.pending[1].append(self.offset)
+        self.pending[2].append(self.nreads)
+        if len(rec_offsets) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        for fh, arr in zip(self.fhs, self.pending):
+            arr.tofile(fh)
+            fh.flush()
+        self.pending = [array.array('Q'), array.array('Q'), array.array('Q')]
+
+    def state(self):
+        """ Flush, then return what a new writer needs to resume from here """
+        self.flush()
+        return {'offset': self.offset, 'nreads': self.nreads, 'nblocks': self.nblocks,
+                'sizes': [fh.tell() for fh in self.fhs]}
+
+    def close(self):
+        if self.fhs is None:
+            return
+        self.pending[0].append(self.offset)
+        self.flush()
+        ofh = self.fhs[0]
+        for fh, tmp_fn in zip(self.fhs[1:], self.tmp_fns[1:]):
+            fh.close()
+            with open(tmp_fn, 'rb') as ifh:
+                shutil.copyfileobj(ifh, ofh)
+            os.remove(tmp_fn)
+        ofh.seek(0)
+        ofh.write(INDEX_HEADER.pack(INDEX_MAGIC, self.nreads, self.nblocks,
+                                    self.block_bytes, self.reads_per_block))
+        ofh.close()
+        self.fhs = None
+        os.rename(self.tmp_fns[0], self.fn)
+
+
+class FastqIndex(object):
+    """ Reads a sidecar index written by IndexWriter """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.fh = open(fn, 'rb')
+        magic, self.nreads, self.nblocks, self.block_bytes, self.reads_per_block = \
+            INDEX_HEADER.unpack(self.fh.read(INDEX_HEADER.size))
+        if magic != INDEX_MAGIC:
+            raise RuntimeError('"%s" is not a FASTQ index' % fn)
+        self.rec_base = INDEX_HEADER.size
+        self.block_base = self.rec_base + 8 * (self.nreads + 1)
+        self.first_read_base = self.block_base + 8 * (self.nblocks + 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.fh.close()
+
+    def _read(self, base, i, j):
+        self.fh.seek(base + 8 * i)
+        arr = array.array('Q')
+        arr.frombytes(self.fh.read(8 * (j - i)))
+        if len(arr) != j - i:
+            raise RuntimeError('Truncated FASTQ index "%s"' % self.fn)
+        return arr
+
+    def record_offset(self, i):
+        """ Byte offset of record i; i == nreads gives the file size """
+        return self._read(self.rec_base, i, i + 1)[0]
+
+    def record_offsets(self, i, j):
+        """ Byte offsets of records i through j, inclusive """
+        return self._read(self.rec_base, i, j + 1)
+
+    def block_offsets(self):
+        """ Offset of each block, followed by the file size """
+        return self._read(self.block_base, 0, self.nblocks + 1)
+
+    def block_first_reads(self):
+        """ Index of the first record in each block, followed by nreads """
+        return self._read(self.first_read_base, 0, self.nblocks + 1)
+
+    def file_size(self):
+        return self.record_offset(self.nreads)
+
+
+def build_index(fn, chunk_size=4 * 1024 * 1024):
+    """ Scan uncompressed FASTQ file fn and write its sidecar index.  Each
+        chunk's worth of whole records becomes a block, so block_bytes and
+        reads_per_block are 0. """
+    if fn.endswith('.gz'):
+        raise RuntimeError('Cannot index compressed file "%s"' % fn)
+    wr = IndexWriter(index_fn(fn))
+    with FastqReader(fn, chunk_size=chunk_size) as rdr:
+        for view, nrec in rdr.batches():
+            line_lens = iter(list(map(len, view.tobytes().split(b'\n'))))
+            wr.add_block([a + b + c + d + 4 for a, b, c, d in zip(*([line_lens] * 4))])
+    wr.close()
+
+
+def open_index(fn):
+    """ Open the sidecar index for FASTQ file fn, if there is an up-to-date
+        one; otherwise return None """
+    ifn = index_fn(fn)
+    if not os.path.exists(ifn) or os.path.getmtime(ifn) < os.path.getmtime(fn):
+        return None
+    idx = FastqIndex(ifn)
+    if idx.file_size() != os.path.getsize(fn):
+        idx.close()
+        return None
+    return idx
@@ -20,9 +20,21 @@ import argparse
 import subprocess
 import tempfile
 import time
-import datetime
 import signal
+import asyncio
+import concurrent.futures
+import errno
+import threading
 import multiprocessing
+import multiprocessing.pool
+import hashlib
+import struct
+import bisect
+import math
+import mmap
+import fastq
+import procmon
+import topology
 
 
 join = os.path.join
@@ -57,14 +69,26 @@ def tool_ext(tool):
         raise RuntimeError('Unknown tool: "%s"' % tool)
 
 
-def make_tool_version(name, tool, preproc, build_dir):
-    """ Builds target in specified clone """
+def make_tool_version(name, tool, preproc, build_dir, njobs=1, log_fn=None):
+    """ Builds target in specified clone, with output going to log_fn if
+        given """
     exe = tool_exe(tool)
-    cmd = "make -e -C %s %s %s" % (build_dir, preproc, exe)
+    cmd = "make -e -j %d -C %s %s %s" % (njobs, build_dir, preproc, exe)
     print(cmd)
+    if log_fn is not None:
+        cmd += ' >%s 2>&1' % log_fn
     ret = os.system(cmd)
     if ret != 0:
-        raise RuntimeError('non-zero return from make for %s version "%s"' % (tool, name))
+        raise RuntimeError('non-zero return from make for %s version "%s"%s' %
+                           (tool, name, '' if log_fn is None else '; see "%s"' % log_fn))
+
+
+def make_job(job):
+    """ Pool worker for make_tool_version; returns name and # seconds """
+    name, tool, preproc, build_dir, njobs, log_fn = job
+    ti = time.time()
+    make_tool_version(name, tool, preproc, build_dir, njobs=njobs, log_fn=log_fn)
+    return name, time.time() - ti
 
 
 def install_tool_version(name, tool, url, branch, preproc, build_dir, make_tool=True):
@@ -98,19 +122,71 @@ def get_configs(config_fn):
             yield name, tool, branch, int(mp_mt), preproc, args.rstrip()
 
 
+def index_files(basename, tool):
+    """ Names of all the index files tool loads """
+    if tool == 'bwa':
+        return [basename + x for x in ['.amb', '.ann', '.pac', '.bwt', '.sa']]
+    te = tool_ext(tool)
+    exts = ['.1.', '.2.', '.3.', '.4.', '.rev.1.', '.rev.2.']
+    if tool == 'hisat':
+        exts += ['.5.', '.6.', '.rev.5.', '.rev.6.']
+    return [basename + x + te for x in exts]
+
+
 def verify_index(basename, tool):
     """ Check that all index files exist """
-    def _ext_exists(ext):
-        print('#  checking for "%s"' % (basename + ext), file=sys.stderr)
-        return os.path.exists(basename + ext)
-    if tool == 'bwa':
-        ret = all(_ext_exists(x) for x in ['.amb', '.ann', '.pac', '.bwt', '.sa'])
-    else:
-        te = tool_ext(tool)
-        ret = all(_ext_exists(x + te) for x in ['.1.', '.2.', '.3.', '.4.', '.rev.1.', '.rev.2.'])
-        if ret and tool == 'hisat':
-            return all(_ext_exists(x + te) for x in ['.5.', '.6.', '.rev.5.', '.rev.6.'])
-    return ret
+    def _exists(fn):
+        print('#  checking for "%s"' % fn, file=sys.stderr)
+        return os.path.exists(fn)
+    return all(_exists(fn) for fn in index_files(basename, tool))
+
+
+def evict_page_cache(fns):
+    """ Drop the files' pages from the page cache, so the next reader finds
+        them cold.  Only clean pages that nothing else has mapped are
+        dropped, which is the usual case for an index between runs. """
+    if not hasattr(os, 'posix_fadvise'):
+        raise RuntimeError('Evicting files from the page cache needs posix_fadvise')
+    for fn in fns:
+        fd = os.open(fn, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def warm_page_cache(fns):
+    """ Bring the files into the page cache: map each one, ask for it to be
+        read ahead with madvise(WILLNEED), then touch every page so that
+        all of it is resident when this returns.  Returns # bytes. """
+    nbytes = 0
+    for fn in fns:
+        size = os.path.getsize(fn)
+        if size == 0:
+            continue
+        with open(fn, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_WILLNEED)
+                for off in range(0, size, mmap.PAGESIZE):
+                    mm[off]
+            finally:
+                mm.close()
+        nbytes += size
+    return nbytes
+
+
+def set_index_cache(basename, tool, state):
+    """ Make the index cold or warm in the page cache """
+    ti = time.time()
+    if state == 'cold':
+        evict_page_cache(index_files(basename, tool))
+        print('#   Evicted %s index from page cache in %0.2f seconds' % (tool, time.time() - ti), file=sys.stderr)
+    elif state == 'warm':
+        nbytes = warm_page_cache(index_files(basename, tool))
+        print('#   Warmed %d bytes of %s index in page cache in %0.2f seconds' % (nbytes, tool, time.time() - ti),
+              file=sys.stderr)
 
 
 def verify_reads(fns):
@@ -121,11 +197,125 @@ def verify_reads(fns):
     return True
 
 
-def wcl(fn):
-    if fn.endswith('.gz'):
-        return int(subprocess.check_output('gzip -dc ' + fn + ' | wc -l', shell=True).strip().split()[0])
+def wcl(fn, decompress='inline'):
+    return fastq.count_lines(fn, decompress=decompress)
+
+
+def count_reads(fn, decompress='inline'):
+    """ # reads in FASTQ file fn, from its sidecar index if it has one """
+    idx = fastq.open_index(fn)
+    if idx is not None:
+        with idx:
+            return idx.nreads
+    return wcl(fn, decompress=decompress) // 4
+
+
+FICLONERANGE = 0x4020940d  # _IOW(0x94, 13, struct file_clone_range)
+
+
+def clone_range(ifd, ofd, begin, length):
+    """ Reflink length bytes of ifd starting at begin into ofd; False if the
+        filesystem can't, e.g. because it doesn't share extents or because
+        the range isn't block-aligned """
+    try:
+        import fcntl
+        fcntl.ioctl(ofd, FICLONERANGE, struct.pack('=qQQQ', ifd, begin, length, 0))
+        return True
+    except (ImportError, IOError, OSError):
+        return False
+
+
+def copy_fh_range(ifh, ofh, begin, end, chunk_size=4 * 1024 * 1024, kernel_chunk_size=1 << 30):
+    """ Copy bytes [begin, end) of open file ifh to open file ofh, which
+        can be a pipe.  Uses a reflink if possible, otherwise copy_file_range
+        or sendfile so the bytes never pass through userspace, otherwise a
+        buffered copy.  Returns the method used. """
+    length = end - begin
+    ifd, ofd = ifh.fileno(), ofh.fileno()
+    if length > 0 and clone_range(ifd, ofd, begin, length):
+        return 'reflink'
+    done = 0
+    for method in ['copy_file_range', 'sendfile']:
+        if not hasattr(os, method):
+            continue
+        try:
+            if done > 0:
+                os.lseek(ofd, done, os.SEEK_SET)
+            while done < length:
+                n = min(kernel_chunk_size, length - done)
+                if method == 'copy_file_range':
+                    ncopied = os.copy_file_range(ifd, ofd, n, begin + done, done)
+                else:
+                    ncopied = os.sendfile(ofd, ifd, begin + done, n)
+                if ncopied == 0:
+                    raise RuntimeError('"%s" ended before offset %d' % (ifh.name, end))
+                done += ncopied
+            return method
+        except OSError as exception:
+            if exception.errno == errno.EPIPE:
+                raise
+            continue  # e.g. EXDEV, EINVAL or ENOSYS; next method picks up at done
+    ifh.seek(begin + done)
+    if done > 0:
+        ofh.seek(done)
+    remaining = length - done
+    while remaining > 0:
+        buf = ifh.read(min(chunk_size, remaining))
+        if len(buf) == 0:
+            raise RuntimeError('"%s" ended before offset %d' % (ifh.name, end))
+        ofh.write(buf)
+        remaining -= len(buf)
+    return 'copy'
+
+
+def copy_byte_range(ifn, begin, end, ofn):
+    """ Copy bytes [begin, end) of ifn to ofn; returns the method used """
+    with open(ifn, 'rb') as ifh:
+        with open(ofn, 'wb') as ofh:
+            return copy_fh_range(ifh, ofh, begin, end)
+
+
+def cut_slices(ifn, ranges, ofns, sanity=True, jobs=1):
+    """ Copy byte ranges of ifn to the corresponding ofns, jobs at a time.
+        Kernel-side copies don't hold the GIL, so threads are enough. """
+    def _cut(i):
+        begin, end = ranges[i]
+        method = copy_byte_range(ifn, begin, end, ofns[i])
+        if sanity and os.path.getsize(ofns[i]) != end - begin:
+            raise RuntimeError('Expected %d bytes, found %d in "%s"' %
+                               (end - begin, os.path.getsize(ofns[i]), ofns[i]))
+        return method
+    if jobs > 1 and len(ranges) > 1:
+        pool = multiprocessing.pool.ThreadPool(min(jobs, len(ranges)))
+        try:
+            methods = pool.map(_cut, range(len(ranges)))
+        finally:
+            pool.close()
+            pool.join()
     else:
-        return int(subprocess.check_output('wc -l ' + fn, shell=True).strip().split()[0])
+        methods = list(map(_cut, range(len(ranges))))
+    print('#   Cut %d slices (%d bytes) by %s' %
+          (len(ranges), sum(e - b for b, e in ranges), ', '.join(sorted(set(methods)))), file=sys.stderr)
+
+
+def slicing_index(ifn):
+    """ Sidecar index for ifn, first building one if ifn is uncompressed, in
+        a writable directory and lacks an up-to-date index; else None """
+    idx = fastq.open_index(ifn)
+    if idx is None and not ifn.endswith('.gz') and os.access(os.path.dirname(os.path.abspath(ifn)), os.W_OK):
+        print('#   Indexing "%s" so that it can be sliced by offset' % ifn, file=sys.stderr)
+        fastq.build_index(ifn)
+        idx = fastq.open_index(ifn)
+    return idx
+
+
+def indexed_slices(idx, ifn, bounds):
+    """ Byte ranges in ifn of the read ranges [bounds[i], bounds[i+1]),
+        looked up in its sidecar index """
+    if bounds[-1] > idx.nreads:
+        raise RuntimeError('Need %d reads but "%s" has only %d' % (bounds[-1], ifn, idx.nreads))
+    offsets = [idx.record_offset(b) for b in bounds]
+    return list(zip(offsets[:-1], offsets[1:]))
 
 
 def slice_lab(i):
@@ -134,90 +324,1391 @@ def slice_lab(i):
         rem = i % 26
         remc = 'abcdefghijklmnopqrstuvwxyz'[rem]
         ret = remc + ret
-        i /= 26
+        i //= 26
     while len(ret) < 3:
         ret = 'a' + ret
     assert len(ret) == 3
     return ret
 
 
-def slice_all_fastq(reads_per, n, ifn, ofn, sanity=True, compress=False):
-    assert 'block' not in ifn
-    if ifn.endswith('.gz'):
-        feed_cmd = 'gzip -dc ' + ifn
-    else:
-        feed_cmd = 'cat ' + ifn
-    head_cmd = 'head -n %d' % (reads_per * n * 4)
-    split_cmd = 'split -l %d -a 3 - %s' % (reads_per * 4, ofn)
-    cmd = ' | '.join([feed_cmd, head_cmd, split_cmd])
-    print(cmd)
-    ret = os.system(cmd)
-    if ret != 0:
-        raise RuntimeError('Exitlevel %d from command "%s"' % (ret, cmd))
-    if sanity:
+def split_fastq(bounds, ifn, ofn, sanity=True, decompress='inline', jobs=1):
+    """ Split reads [bounds[0], bounds[-1]) of ifn into files named ofn
+        followed by a slice_lab() suffix, slice i holding reads
+        [bounds[i], bounds[i+1]) """
+    n = len(bounds) - 1
+    idx = slicing_index(ifn)
+    if idx is not None:
+        with idx:
+            ranges = indexed_slices(idx, ifn, bounds)
+        cut_slices(ifn, ranges, [ofn + slice_lab(i) for i in range(n)], sanity=sanity, jobs=jobs)
+        return
+    with fastq.FastqReader(ifn, decompress=decompress) as rdr:
+        nskipped = rdr.skip_records(bounds[0])
+        if sanity and nskipped != bounds[0]:
+            raise RuntimeError('"%s" has fewer than %d reads' % (ifn, bounds[0]))
         for i in range(n):
             fn = ofn + slice_lab(i)
-            actual_nlines = wcl(fn)
-            if actual_nlines != reads_per * 4:
-                raise RuntimeError('Expected %d lines, found %d in "%s"' % (reads_per * 4, actual_nlines, fn))
-
-
-def slice_fastq(begin, end, ifn, ofn, sanity=True):
-    cmd = "sed -n '%d,%dp;%dq' < %s > %s" % (begin * 4 + 1, end * 4, end * 4 + 1, ifn, ofn)
-    print(cmd)
-    ret = os.system(cmd)
-    if ret != 0:
-        raise RuntimeError('Exitlevel %d from command "%s"' % (ret, cmd))
-    if sanity:
-        actual_nlines = wcl(ofn)
-        if actual_nlines != (end - begin) * 4:
-            raise RuntimeError('Expected %d lines, found %d in "%s"' % ((end - begin)*4, actual_nlines, ofn))
+            nreads = bounds[i+1] - bounds[i]
+            with open(fn, 'wb') as ofh:
+                ncopied = rdr.copy_records(nreads, ofh)
+            if sanity and ncopied != nreads:
+                raise RuntimeError('Expected %d lines, found %d in "%s"' % (nreads * 4, ncopied * 4, fn))
+
+
+def slice_all_fastq(reads_per, n, ifn, ofn, sanity=True, decompress='inline', jobs=1):
+    """ Split the first reads_per * n reads of ifn into n files named ofn
+        followed by a slice_lab() suffix """
+    print('#   Splitting %d x %d reads from "%s" into "%s???"' % (n, reads_per, ifn, ofn), file=sys.stderr)
+    split_fastq([i * reads_per for i in range(n + 1)], ifn, ofn, sanity=sanity, decompress=decompress, jobs=jobs)
+
+
+def block_bounds(reads_per, n, ifn, block_bytes, reads_per_block):
+    """ Read boundaries for splitting blocked FASTQ ifn into n slices of
+        about reads_per reads each, where every slice starts on a block
+        boundary and holds whole blocks.  Blocks hold reads_per_block reads
+        unless the sidecar index says the blocks are packed. """
+    idx = fastq.open_index(ifn)
+    if idx is not None and idx.block_bytes > 0:
+        with idx:
+            if idx.block_bytes != block_bytes:
+                raise RuntimeError('Index for "%s" says block size is %d, but --input-block-bytes is %d' %
+                                   (ifn, idx.block_bytes, block_bytes))
+            if idx.reads_per_block == 0:
+                # packed blocks: start each slice at the first block starting
+                # at or after where it would start without blocks
+                firsts = idx.block_first_reads()
+                if reads_per * n > firsts[-1]:
+                    raise RuntimeError('Need %d reads but "%s" has only %d' % (reads_per * n, ifn, firsts[-1]))
+                return [firsts[bisect.bisect_left(firsts, i * reads_per)] for i in range(n + 1)]
+            if idx.reads_per_block != reads_per_block:
+                raise RuntimeError('Index for "%s" says there are %d reads per block, but --input-reads-per-block '
+                                   'is %d' % (ifn, idx.reads_per_block, reads_per_block))
+    blocks_per = (reads_per + reads_per_block - 1) // reads_per_block
+    return [i * blocks_per * reads_per_block for i in range(n + 1)]
+
+
+def slice_bounds(args, src, nprocess, nreads_per_process, align_blocks):
+    """ Read boundaries of the per-process slices of src, aligned to its
+        blocks if align_blocks """
+    if align_blocks:
+        bounds = block_bounds(nreads_per_process, nprocess, src, args.input_block_bytes,
+                              args.input_reads_per_block)
+        sizes = [e - b for b, e in zip(bounds[:-1], bounds[1:])]
+        if min(sizes) != nreads_per_process or max(sizes) != nreads_per_process:
+            print('#   Block-aligned slices of "%s" have %d-%d reads each, rather than %d' %
+                  (src, min(sizes), max(sizes), nreads_per_process), file=sys.stderr)
+        return bounds
+    return [i * nreads_per_process for i in range(nprocess + 1)]
+
+
+def slice_fastq(begin, end, ifn, ofn, sanity=True, decompress='inline'):
+    """ Write reads [begin, end) of ifn to ofn """
+    print('#   Copying reads [%d, %d) from "%s" to "%s"' % (begin, end, ifn, ofn), file=sys.stderr)
+    idx = slicing_index(ifn)
+    if idx is not None:
+        with idx:
+            ranges = indexed_slices(idx, ifn, [begin, end])
+        cut_slices(ifn, ranges, [ofn], sanity=sanity)
+        return
+    with fastq.FastqReader(ifn, decompress=decompress) as rdr:
+        nskipped = rdr.skip_records(begin)
+        if sanity and nskipped != begin:
+            raise RuntimeError('"%s" has fewer than %d reads' % (ifn, begin))
+        with open(ofn, 'wb') as ofh:
+            ncopied = rdr.copy_records(end - begin, ofh)
+    if sanity and ncopied != end - begin:
+        raise RuntimeError('Expected %d lines, found %d in "%s"' % ((end - begin)*4, ncopied*4, ofn))
+
+
+class SliceCache(object):
+    """ Persistent cache of the read slices made by prepare_reads, kept in a
+        directory under --tempdir.  An entry holds the slices cut from one
+        mate's source file for one set of per-process read boundaries,
+        and is named by a hash of that key plus the source file's identity.
+        Least recently used entries are evicted to keep the total size under
+        max_bytes; entries handed out by get() are never evicted until the
+        read set holding them is passed to release(). """
+
+    def __init__(self, dr, max_bytes):
+        self.dr = dr
+        self.max_bytes = max_bytes
+        self.pinned = {}
+        self.lock = threading.Lock()
+        self.nhit, self.nmiss, self.hit_bytes = 0, 0, 0
+        mkdir_quiet(dr)
+        for fn in os.listdir(dr):
+            if fn.endswith('.tmp'):
+                # left behind by an interrupted fill
+                shutil.rmtree(join(dr, fn))
+
+    @staticmethod
+    def source_id(fn):
+        """ Identify a source file by path, size and modification time, which
+            is much cheaper than hashing tens of GB """
+        st = os.stat(fn)
+        return '%s:%d:%d' % (os.path.realpath(fn), st.st_size, int(st.st_mtime))
+
+    @staticmethod
+    def entry_bytes(dr):
+        return sum(os.path.getsize(join(dr, fn)) for fn in os.listdir(dr))
+
+    def entries(self):
+        """ Complete entries as (last use, # bytes, name), oldest first """
+        ret = []
+        for name in os.listdir(self.dr):
+            done_fn = join(self.dr, name, 'DONE')
+            if not name.endswith('.tmp') and os.path.exists(done_fn):
+                ret.append((os.path.getmtime(done_fn), self.entry_bytes(join(self.dr, name)), name))
+        return sorted(ret)
+
+    def get(self, src, bounds, blocked, mate, fill):
+        """ Return the slice files holding reads [bounds[i], bounds[i+1]) of
+            src, calling fill(prefix) to create files named prefix +
+            slice_lab(i) on a miss.  Keying on the actual read boundaries
+            keeps block-aligned slices apart from unaligned ones of the
+            same nominal size. """
+        nprocess = len(bounds) - 1
+        key = '\t'.join(map(str, [self.source_id(src), ','.join(map(str, bounds)), blocked, mate]))
+        name = hashlib.sha1(key.encode()).hexdigest()
+        dr = join(self.dr, name)
+        fns = [join(dr, slice_lab(i)) for i in range(nprocess)]
+        if os.path.exists(join(dr, 'DONE')):
+            nbytes = self.entry_bytes(dr)
+            print('#   Slice cache hit for mate %d of "%s" (%d bytes)' % (mate, src, nbytes), file=sys.stderr)
+            self.nhit += 1
+            self.hit_bytes += nbytes
+            os.utime(join(dr, 'DONE'), None)
+        else:
+            print('#   Slice cache miss for mate %d of "%s"' % (mate, src), file=sys.stderr)
+            self.nmiss += 1
+            tmp_dr = dr + '.tmp'
+            if os.path.exists(dr):
+                shutil.rmtree(dr)
+            mkdir_quiet(tmp_dr)
+            fill(join(tmp_dr, ''))
+            for fn in fns:
+                if not os.path.exists(join(tmp_dr, os.path.basename(fn))):
+                    raise RuntimeError('Split failed to create file "%s"' % fn)
+            with open(join(tmp_dr, 'KEY'), 'w') as fh:
+                fh.write(key + '\n')
+            open(join(tmp_dr, 'DONE'), 'w').close()
+            os.rename(tmp_dr, dr)
+        with self.lock:
+            self.pinned[name] = self.pinned.get(name, 0) + 1
+        return fns
+
+    def release(self, read_set):
+        """ read_set is no longer in use; its entries may be evicted """
+        names = set(os.path.basename(os.path.dirname(fn)) for read_list in read_set for fn in read_list)
+        with self.lock:
+            for name in names:
+                self.pinned[name] -= 1
+                if self.pinned[name] == 0:
+                    del self.pinned[name]
+
+    def evict(self):
+        """ Evict unpinned entries, least recently used first, until under
+            budget """
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        entries = self.entries()
+        tot = sum(nbytes for _, nbytes, _ in entries)
+        for _, nbytes, name in entries:
+            if tot <= self.max_bytes:
+                break
+            if name in self.pinned:
+                continue
+            print('#   Evicting slice cache entry "%s" (%d bytes)' % (name, nbytes), file=sys.stderr)
+            shutil.rmtree(join(self.dr, name))
+            tot -= nbytes
 
 
-def prepare_reads(args, nthread, mp_mt, tmpdir, blocked=False):
-    read_sets = []
+def slice_plan(args, nthread, mp_mt, blocked, reads_per_thread=None):
+    """ Return # processes, # reads per process and the source file for each
+        mate, for an experiment with nthread threads and reads_per_thread
+        (default: --reads-per-thread) reads per thread """
+    if reads_per_thread is None:
+        reads_per_thread = args.reads_per_thread
     if mp_mt > 0:
-        if blocked:
-            raise RuntimeError('Unexpected combination of multiprocessing and blocked input')
         assert nthread % mp_mt == 0
         nprocess = int(nthread / mp_mt + 0.01)
-        nreads_per_process = int((args.reads_per_thread * nthread) / nprocess + 0.01)
-        prefs = list(map(lambda x: join(tmpdir, "%d_" % x), [1, 2]))
-        slice_all_fastq(nreads_per_process, nprocess, args.m1, prefs[0])
-        if args.m2 is not None:
-            slice_all_fastq(nreads_per_process, nprocess, args.m2, prefs[1])
-        for i in range(nprocess):
-            fn0, fn1 = join(tmpdir, "1_" + slice_lab(i)), join(tmpdir, "2_" + slice_lab(i))
-            if not os.path.exists(fn0):
-                raise RuntimeError('Split failed to create file "%s"' % fn0)
-            if args.m2 is not None:
-                if not os.path.exists(fn1):
-                    raise RuntimeError('Split failed to create file "%s"' % fn1)
-                read_sets.append([fn0, fn1])
-            else:
-                read_sets.append([fn0])
-        extra_fn = join(tmpdir, "1_" + slice_lab(nprocess))
-        if os.path.exists(extra_fn):
-            raise RuntimeError('Got one more output file than expected from split: "%s"' % extra_fn)
+        nreads_per_process = int((reads_per_thread * nthread) / nprocess + 0.01)
     else:
-        rds_1 = join(tmpdir, "1.fq")
-        rds_2 = join(tmpdir, "2.fq")
-        nreads = args.reads_per_thread * nthread
-        slice_fastq(0, nreads, args.m1b if blocked else args.m1, rds_1)
-        if args.m2 is not None:
-            slice_fastq(0, nreads, args.m2b if blocked else args.m2, rds_2)
-            read_sets.append([rds_1, rds_2])
+        nprocess = 1
+        nreads_per_process = reads_per_thread * nthread
+    srcs = [args.m1b, args.m2b] if blocked else [args.m1, args.m2]
+    if args.m2 is None:
+        srcs = srcs[:1]
+    return nprocess, nreads_per_process, srcs
+
+
+def prepare_reads(args, nthread, mp_mt, tmpdir, blocked=False, cache=None, reads_per_thread=None):
+    read_sets = []
+    nprocess, nreads_per_process, srcs = slice_plan(args, nthread, mp_mt, blocked, reads_per_thread)
+
+    def fill(src, bounds):
+        def _fill(pref):
+            if mp_mt > 0 and blocked:
+                print('#   Splitting reads [0, %d) from "%s" into %d block-aligned slices "%s???"' %
+                      (bounds[-1], src, nprocess, pref), file=sys.stderr)
+                split_fastq(bounds, src, pref, decompress=args.decompress, jobs=args.slice_jobs)
+            elif mp_mt > 0:
+                slice_all_fastq(nreads_per_process, nprocess, src, pref, decompress=args.decompress,
+                                jobs=args.slice_jobs)
+            else:
+                slice_fastq(0, nreads_per_process, src, pref + slice_lab(0), decompress=args.decompress)
+        return _fill
+
+    mate_fns = []
+    for mate, src in enumerate(srcs, 1):
+        bounds = slice_bounds(args, src, nprocess, nreads_per_process, mp_mt > 0 and blocked)
+        if cache is not None:
+            fns = cache.get(src, bounds, blocked, mate, fill(src, bounds))
         else:
-            read_sets.append([rds_1])
+            pref = join(tmpdir, "%d_" % mate)
+            fill(src, bounds)(pref)
+            fns = [pref + slice_lab(i) for i in range(nprocess)]
+            for fn in fns:
+                if not os.path.exists(fn):
+                    raise RuntimeError('Split failed to create file "%s"' % fn)
+        mate_fns.append(fns)
+    if cache is not None:
+        cache.evict()
+    for i in range(nprocess):
+        read_sets.append([fns[i] for fns in mate_fns])
     return read_sets
 
 
+class FifoFeeder(object):
+    """ Thread that streams reads [begin, end) of src into the named pipe
+        fifo while an aligner reads from the other end.  Keeps track of how
+        long it waited for the aligner to open the pipe and how fast it then
+        fed it. """
+
+    def __init__(self, src, begin, end, fifo, decompress='inline'):
+        self.src, self.begin, self.end, self.fifo = src, begin, end, fifo
+        self.decompress = decompress
+        self.nbytes = 0
+        self.method = None
+        self.status = 'waiting'
+        self.t_start = self.t_open = self.t_done = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.t_start = time.time()
+        self.thread.start()
+
+    def _run(self):
+        try:
+            idx = fastq.open_index(self.src)
+            with open(self.fifo, 'wb') as ofh:
+                self.t_open = time.time()
+                self.status = 'feeding'
+                if idx is not None:
+                    with idx:
+                        (begin_off, end_off), = indexed_slices(idx, self.src, [self.begin, self.end])
+                    with open(self.src, 'rb') as ifh:
+                        self.method = copy_fh_range(ifh, ofh, begin_off, end_off)
+                    self.nbytes = end_off - begin_off
+                else:
+                    self.method = 'stream'
+                    with fastq.FastqReader(self.src, decompress=self.decompress) as rdr:
+                        if rdr.skip_records(self.begin) != self.begin:
+                            raise RuntimeError('"%s" has fewer than %d reads' % (self.src, self.begin))
+                        off = rdr.tell()
+                        ncopied = rdr.copy_records(self.end - self.begin, ofh)
+                        self.nbytes = rdr.tell() - off
+                    if ncopied != self.end - self.begin:
+                        raise RuntimeError('"%s" has fewer than %d reads' % (self.src, self.end))
+            self.status = 'done'
+        except (IOError, OSError) as exception:
+            # e.g. EPIPE when the aligner exits or is killed before reading
+            # everything
+            self.status = 'error: %s' % exception.strerror
+        except Exception as exception:
+            # e.g. a short source; closing the pipe early would otherwise
+            # look like a clean end of input to the aligner
+            self.status = 'error: %s' % exception
+        self.t_done = time.time()
+
+    def abort(self):
+        """ Unblock a feeder whose aligner exited without opening the pipe """
+        if self.thread.is_alive() and self.t_open is None:
+            try:
+                os.close(os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        self.thread.join(5)
+
+    def summary(self):
+        wait = (self.t_open or self.t_done or time.time()) - self.t_start
+        feed = (self.t_done - self.t_open) if self.t_open is not None and self.t_done is not None else 0.0
+        mbps = self.nbytes / feed / (1024.0 * 1024.0) if feed > 0 else 0.0
+        return wait, feed, mbps
+
+
+def prepare_streams(args, nthread, mp_mt, tmpdir, blocked=False, reads_per_thread=None):
+    """ Like prepare_reads, but make a named pipe for each process and mate
+        instead of a slice; returns the read sets and, for each process and
+        mate, the arguments for the FifoFeeder that fills the pipe """
+    nprocess, nreads_per_process, srcs = slice_plan(args, nthread, mp_mt, blocked, reads_per_thread)
+    read_sets, feeds = [], []
+    bounds = [slice_bounds(args, src, nprocess, nreads_per_process, blocked and mp_mt > 0) for src in srcs]
+    for i in range(nprocess):
+        read_set = []
+        for mate, src in enumerate(srcs, 1):
+            fifo = join(tmpdir, '%d_%s.fifo' % (mate, slice_lab(i)))
+            if os.path.exists(fifo):
+                os.remove(fifo)
+            os.mkfifo(fifo)
+            read_set.append(fifo)
+            feeds.append((i, mate, src, bounds[mate-1][i], bounds[mate-1][i+1], fifo))
+        read_sets.append(read_set)
+    return read_sets, feeds
+
+
+def write_feed_summary(feeders, feeds, ofn):
+    """ Write one line per feeder giving its throughput.  A feeder that
+        spent about as long feeding as the aligner ran, at well below the
+        storage's bandwidth, probably limited the run. """
+    with open(ofn, 'w') as fh:
+        fh.write('\t'.join(['process', 'mate', 'source', 'reads', 'bytes', 'method', 'status',
+                            'wait_sec', 'feed_sec', 'mb_per_sec']) + '\n')
+        for feeder, (i, mate, src, begin, end, _) in zip(feeders, feeds):
+            wait, feed, mbps = feeder.summary()
+            fh.write('\t'.join(map(str, [i, mate, src, end - begin, feeder.nbytes, feeder.method,
+                                         feeder.status, '%0.3f' % wait, '%0.3f' % feed, '%0.2f' % mbps])) + '\n')
+
+
+def start_monitors(prefix, iostat_x):
+    """ Start top and iostat in the background, for systems without the
+        /proc files that procmon samples; returns (process, output file)
+        for each """
+    iostat_cmd = ['iostat']
+    if iostat_x:
+        iostat_cmd.append('-x')
+    iostat_cmd.append('2')
+    if sys.platform == 'darwin':
+        top_cmd = 'top -l 0 -s 2'.split()
+    else:
+        top_cmd = 'top -b -d 2'.split()
+    monitors = []
+    for cmd, ext in [(iostat_cmd, '.iostat'), (top_cmd, '.top')]:
+        if os.system('which %s >/dev/null 2>/dev/null' % cmd[0]) == 0:
+            ofh = open(prefix + ext, 'w')
+            monitors.append((subprocess.Popen(cmd, stdout=ofh, stderr=ofh), ofh))
+    return monitors
+
+
+def kill_group(pid, grace=10):
+    """ SIGTERM the process group led by pid, then SIGKILL it if it's
+        still there after grace seconds """
+    def _kill(sig):
+        try:
+            os.killpg(pid, sig)
+            return True
+        except OSError:
+            return False  # already gone
+    if _kill(signal.SIGTERM):
+        timer = threading.Timer(grace, _kill, [signal.SIGKILL])
+        timer.daemon = True
+        timer.start()
+
+
+# run in place of taskset when it isn't installed: sets its own affinity to
+# the CPU list in argv[1], then execs the aligner command that follows
+AFFINITY_SHIM = ('import os, sys; os.sched_setaffinity(0, map(int, sys.argv[1].split(","))); '
+                 'os.execvp(sys.argv[2], sys.argv[2:])')
+
+
+async def supervise_async(cmds, ofns, efns, timeout, on_start=None, on_exit=None, cpusets=None):
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + timeout
+    results = [None] * len(cmds)
+    taskset = shutil.which('taskset')
+    # one thread per process, each blocked in wait4() until its process exits
+    waiters = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(cmds)))
+
+    def _reap(pid):
+        _, status, rusage = os.wait4(pid, 0)
+        if on_exit is not None:
+            on_exit(pid, rusage)
+        return os.waitstatus_to_exitcode(status)
+
+    async def _run(i):
+        with open(ofns[i], 'wb') as ofh:
+            with open(efns[i], 'wb') as efh:
+                print(' '.join(cmds[i]))
+                cmd = cmds[i]
+                if cpusets is not None:
+                    # taskset (or the shim) sets the affinity and then execs
+                    # the aligner, so it's in place before the aligner starts
+                    # any threads
+                    if taskset is not None:
+                        cmd = [taskset, '-c', topology.format_cpulist(cpusets[i])] + cmd
+                    else:
+                        cmd = [sys.executable, '-c', AFFINITY_SHIM, ','.join(map(str, sorted(cpusets[i])))] + cmd
+                start = time.monotonic()
+                pid = os.posix_spawnp(cmd[0], cmd, os.environ, setsid=True,
+                                      file_actions=[(os.POSIX_SPAWN_DUP2, ofh.fileno(), 1),
+                                                    (os.POSIX_SPAWN_DUP2, efh.fileno(), 2)])
+                if on_start is not None:
+                    on_start(pid)
+                reaped = loop.run_in_executor(waiters, _reap, pid)
+                try:
+                    exitlevel = await asyncio.wait_for(asyncio.shield(reaped), max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    print('#   Process %d still alive after %d seconds; killing its process group' %
+                          (pid, timeout), file=sys.stderr)
+                    kill_group(pid)
+                    await reaped
+                    exitlevel = None
+                results[i] = (exitlevel, start, time.monotonic())
+
+    try:
+        await asyncio.gather(*[_run(i) for i in range(len(cmds))])
+    finally:
+        waiters.shutdown()
+    return results
+
+
+def supervise(cmds, ofns, efns, timeout, on_start=None, on_exit=None, cpusets=None):
+    """ Run aligner commands concurrently, each in its own session so that
+        it and any children form a process group.  Processes still running
+        timeout seconds after the start are killed along with their groups.
+        Returns (exit level, start, end) for each, where exit level is None
+        if it timed out and start/end are time.monotonic() values.
+        on_start(pid) is called as each process starts, and on_exit(pid,
+        rusage) as each is reaped, with its final resource usage from
+        wait4().  If cpusets is given, process i is confined to the CPUs in
+        cpusets[i], by running it under taskset or, failing that, under
+        AFFINITY_SHIM, either of which sets the affinity before exec'ing
+        the aligner.  Processes are started with posix_spawn and no
+        preexec_fn, since this may be called from several threads at once. """
+    return asyncio.run(supervise_async(cmds, ofns, efns, timeout, on_start=on_start, on_exit=on_exit,
+                                       cpusets=cpusets))
+
+
+def write_wall_times(ofn, exitlevel, start, end, starts, ends, index_cache=None):
+    """ Write one process's wall time for tabulate.py, with its start and
+        end relative to the first process to start, the spread in end
+        times across all processes in the run and, if it was set, whether
+        the index was cold or warm in the page cache """
+    with open(ofn, 'w') as fh:
+        fh.write('wall: %f\n' % (end - start))
+        fh.write('start: %f\n' % (start - min(starts)))
+        fh.write('end: %f\n' % (end - min(starts)))
+        fh.write('skew: %f\n' % (max(ends) - min(ends)))
+        fh.write('exit: %s\n' % ('timeout' if exitlevel is None else exitlevel))
+        if index_cache is not None:
+            fh.write('index_cache: %s\n' % index_cache)
+
+
+def purge_reads(read_set, cache=None):
+    """ Delete the reads prepared for the last experiment, or just hand them
+        back to the cache """
+    if read_set is None:
+        return
+    if cache is not None:
+        cache.release(read_set)
+    else:
+        for read_list in read_set:
+            for read_fn in read_list:
+                os.remove(read_fn)
+
+
+IOPRIO_SET_SYSCALL = {'x86_64': 251, 'i686': 289, 'aarch64': 30, 'ppc64le': 273, 'ppc64': 273}
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+
+def lower_thread_priority(nice, ioclass):
+    """ Give the calling thread CPU niceness nice and I/O priority class
+        ioclass, like "nice -n" and "ionice -c".  On Linux both are
+        per-thread, so the rest of the process is unaffected.  The I/O class
+        only matters under I/O schedulers that honor it, like BFQ. """
+    tid = threading.get_native_id() if hasattr(threading, 'get_native_id') else 0
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, nice)
+    except (AttributeError, OSError) as exception:
+        print('#   Could not renice preparer thread: %s' % exception, file=sys.stderr)
+    if not sys.platform.startswith('linux'):
+        return
+    import ctypes
+    import platform
+    nr = IOPRIO_SET_SYSCALL.get(platform.machine())
+    cls = IOPRIO_CLASSES[ioclass]
+    level = 0 if cls == IOPRIO_CLASSES['idle'] else 7
+    if nr is None or ctypes.CDLL(None, use_errno=True).syscall(nr, 1, tid, (cls << 13) | level) != 0:
+        print('#   Could not set I/O priority of preparer thread', file=sys.stderr)
+
+
+class ReadPreparer(object):
+    """ Prepares read sets on background threads at lowered CPU and I/O
+        priority, so the next read set in the plan can be built while the
+        current run executes.  prepare(i) builds read set i. """
+
+    def __init__(self, prepare, nice=19, ioclass='idle'):
+        self.prepare = prepare
+        self.nice = nice
+        self.ioclass = ioclass
+        self.threads = {}
+        self.results = {}
+
+    def submit(self, i):
+        def _run():
+            lower_thread_priority(self.nice, self.ioclass)
+            try:
+                self.results[i] = (self.prepare(i), None)
+            except Exception as exception:
+                self.results[i] = (None, exception)
+        self.threads[i] = threading.Thread(target=_run)
+        self.threads[i].daemon = True
+        self.threads[i].start()
+
+    def take(self, i):
+        """ Return read set i, waiting for it if it was submitted and
+            building it in the foreground if not """
+        if i not in self.threads:
+            return self.prepare(i)
+        ti = time.time()
+        self.threads.pop(i).join()
+        print('#   Waited %f seconds for read set prepared in background' % (time.time() - ti), file=sys.stderr)
+        read_set, exception = self.results.pop(i)
+        if exception is not None:
+            raise exception
+        return read_set
+
+    def abandon(self, purge):
+        """ Wait for outstanding read sets and hand each to purge """
+        for i in list(self.threads):
+            self.threads.pop(i).join()
+            result, _ = self.results.pop(i)
+            if result is not None:
+                purge(result)
+
+
+def aligner_cmds(args, tool, build_dir, nthreads_per_process, mp_mt, aligner_args, read_set, sam_ofns, stdout_ofns):
+    """ Return the command line for each aligner process of an experiment,
+        and the file its stdout should go to """
+    cmds, ofns = [], []
+    if tool == 'bwa':
+        for i in range(len(read_set)):
+            cmd = ['%s/%s' % (build_dir, tool_exe(tool)), 'mem']
+            cmd.extend(['-t' , str(nthreads_per_process)])
+            if aligner_args is not None and len(aligner_args) > 0:
+                cmd.extend(aligner_args.split())
+            cmd.append(args.index)
+            cmd.append(read_set[i][0])
+            if args.m2 is not None:
+                cmd.append(read_set[i][1])
+            cmds.append(cmd)
+            ofns.append(sam_ofns[i])
+    else:
+        for i in range(len(read_set)):
+            cmd = ['%s/%s' % (build_dir, tool_exe(tool))]
+            cmd.extend(['-p', str(nthreads_per_process)])
+            if aligner_args is not None and len(aligner_args) > 0:
+                cmd.extend(aligner_args.split())
+            if tool == 'bowtie2' or tool == 'hisat':
+                cmd.append('-x')
+            cmd.append(args.index)
+            cmd.append('-t')
+            if mp_mt > 0:
+                cmd.append('--mm')
+            if args.m2 is not None:
+                cmd.extend(['-1', read_set[i][0]])
+                cmd.extend(['-2', read_set[i][1]])
+            elif tool == 'bowtie2' or tool == 'hisat':
+                cmd.extend(['-U', read_set[i][0]])
+            else:
+                cmd.append(read_set[i][0])
+
+            cmd.extend(['-S', sam_ofns[i]])
+            cmds.append(cmd)
+            ofns.append(stdout_ofns[i])
+    return cmds, ofns
+
+
+def make_run_name(name, pe_str, mp_mt, proc, nthreads, attempt):
+    """ Prefix of the output files for one process of one attempt; attempt
+        1 is the recorded one, higher numbers are warm-ups """
+    return '%s_%s_%d_%d_%d_%d' % (name, pe_str, mp_mt, proc, nthreads, attempt)
+
+
+def experiment_plan(args, series, skip=None, reads_per_thread=None):
+    """ List all experiments in the order they run, as (nthreads, name,
+        tool, mp_mt, aligner_args, blocked, rs) tuples.  rs is the index
+        into the read-set list, also returned, of the read set the
+        experiment uses.  A read set is (nthreads, mp_mt, blocked, name,
+        reads_per_thread), where reads_per_thread comes from the
+        reads_per_thread dict, keyed by (name, nthreads), if given and
+        from --reads-per-thread otherwise.  Experiments for which
+        skip(nthreads, name, mp_mt) is true are left out, along with any
+        read sets only they would use. """
+    plan, read_sets = [], []
+    for nthreads in series:
+        last_mp_mt, last_blocked, last_rpt = None, False, None
+        for name, tool, branch, mp_mt, preproc, aligner_args in get_configs(args.config):
+            if mp_mt != 0 and (nthreads % mp_mt != 0):
+                continue  # skip experiment if # threads isn't evenly divisible
+            if skip is not None and skip(nthreads, name, mp_mt):
+                continue
+            blocked = aligner_args is not None and 'block-bytes' in aligner_args
+            rpt = args.reads_per_thread
+            if reads_per_thread is not None:
+                rpt = reads_per_thread.get((name, nthreads), rpt)
+            if last_mp_mt is None or mp_mt != last_mp_mt or blocked != last_blocked or rpt != last_rpt:
+                read_sets.append((nthreads, mp_mt, blocked, name, rpt))
+                last_mp_mt = mp_mt
+            last_blocked, last_rpt = blocked, rpt
+            plan.append((nthreads, name, tool, mp_mt, aligner_args, blocked, len(read_sets) - 1))
+    return plan, read_sets
+
+
+def parse_hms(tmst):
+    """ Seconds in a time like 00:00:20.798, as printed by the aligners' -t """
+    toks = tmst.split(':')
+    assert len(toks) == 3
+    return float(toks[0]) * 60 * 60 + float(toks[1]) * 60 + float(toks[2])
+
+
+def parse_search_time(fn):
+    """ Search time from an aligner's stderr, found the same way
+        tabulate.py finds it; None if there isn't one """
+    search_time = None
+    with open(fn) as fh:
+        for ln in fh:
+            if ln.startswith('Multiseed full-index') or ln.startswith('Time searching:'):
+                search_time = parse_hms(ln.split()[-1])
+            elif ln.startswith('[kt_pipeline]'):
+                search_time = (search_time or 0) + float(ln.split()[3])
+    return search_time
+
+
+# probes whose search takes less than this are too noisy to extrapolate from
+PROBE_MIN_SECONDS = 2.0
+
+
+def probe_search_time(args, pe_str, tmpdir, nthreads, name, tool, mp_mt, aligner_args, blocked,
+                      reads_per_thread, cpu_topology=None):
+    """ Run an experiment with reads_per_thread reads per thread in tmpdir
+        and return the search time of its slowest process """
+    build_dir = join(args.build_dir, pe_str, name)
+    nprocess = 1 if mp_mt == 0 else nthreads // mp_mt
+    nthreads_per_process = nthreads if mp_mt == 0 else mp_mt
+    probe_dir = join(tmpdir, 'probe', name, pe_str, '%d_%d' % (nthreads, reads_per_thread))
+    mkdir_quiet(probe_dir)
+    read_set = prepare_reads(args, nthreads, mp_mt, probe_dir, blocked=blocked, reads_per_thread=reads_per_thread)
+    run_names = [make_run_name(name, pe_str, mp_mt, i, nthreads, 0) for i in range(nprocess)]
+    efns = [join(probe_dir, runname + '.err') for runname in run_names]
+    stdout_ofns = [join(probe_dir, runname + '.out') for runname in run_names]
+    sam_ofns = [('/dev/null' if args.sam_dev_null else join(probe_dir, runname + '.sam')) for runname in run_names]
+    cmds, ofns = aligner_cmds(args, tool, build_dir, nthreads_per_process, mp_mt, aligner_args,
+                              read_set, sam_ofns, stdout_ofns)
+    cpusets = None
+    if cpu_topology is not None:
+        cpusets = [set(c.cpu for c in cpus)
+                   for cpus in topology.assign(cpu_topology, args.pin, nprocess, nthreads_per_process)]
+    results = supervise(cmds, ofns, efns, args.timeout, cpusets=cpusets)
+    purge_reads(read_set)
+    for sam_ofn in sam_ofns:
+        if sam_ofn != '/dev/null' and os.path.exists(sam_ofn):
+            os.remove(sam_ofn)
+    if any(exitlevel != 0 for exitlevel, _, _ in results):
+        raise RuntimeError('Calibration probe of "%s" with %d threads failed or timed out; see "%s"' %
+                           (name, nthreads, efns[0]))
+    search_times = [parse_search_time(efn) for efn in efns]
+    if any(search_time is None for search_time in search_times):
+        raise RuntimeError('No search time in calibration probe output "%s"' % efns[0])
+    return max(search_times)
+
+
+def calibrate(args, pe_str, tmpdir, plan, nreads_tot=None, cpu_topology=None):
+    """ Choose reads per thread for each (name, nthreads) in the experiment
+        plan so that the search takes about --target-seconds.  Each choice
+        comes from a short probe run, and is recorded in calibration.tsv in
+        the config's output directory so later invocations (e.g. with
+        --resume) reuse it rather than probing again.  Choices are rounded
+        to two significant digits, so that similar configs can share read
+        sets, and capped by the # input reads if known.  Returns a dict
+        from (name, nthreads) to reads per thread. """
+    cols = ['nthreads', 'target_seconds', 'probe_reads_per_thread', 'probe_seconds', 'reads_per_second',
+            'reads_per_thread']
+    ret = {}
+    for nthreads, name, tool, mp_mt, aligner_args, blocked, _ in plan:
+        if (name, nthreads) in ret:
+            continue
+        calib_fn = join(args.output_dir, pe_str, name, 'calibration.tsv')
+        if os.path.exists(calib_fn):
+            with open(calib_fn) as fh:
+                for ln in fh:
+                    toks = ln.rstrip().split('\t')
+                    if toks[0] == str(nthreads) and float(toks[1]) == args.target_seconds:
+                        ret[(name, nthreads)] = int(toks[-1])
+        if (name, nthreads) in ret:
+            print('#   %s, nthreads=%d: using recorded %d reads per thread' %
+                  (name, nthreads, ret[(name, nthreads)]), file=sys.stderr)
+            continue
+        max_rpt = None if nreads_tot is None else nreads_tot // nthreads
+        probe_rpt = args.probe_reads_per_thread if max_rpt is None else min(args.probe_reads_per_thread, max_rpt)
+        for _ in range(4):
+            secs = probe_search_time(args, pe_str, tmpdir, nthreads, name, tool, mp_mt, aligner_args, blocked,
+                                     probe_rpt, cpu_topology=cpu_topology)
+            print('#   %s, nthreads=%d: probe with %d reads per thread searched for %0.2f seconds' %
+                  (name, nthreads, probe_rpt, secs), file=sys.stderr)
+            if secs >= PROBE_MIN_SECONDS or probe_rpt == max_rpt:
+                break
+            # grow the probe to about twice the minimum
+            probe_rpt = int(probe_rpt * min(10.0, 2 * PROBE_MIN_SECONDS / max(secs, 0.01)))
+            if max_rpt is not None:
+                probe_rpt = min(probe_rpt, max_rpt)
+        rate = sliced_reads(args, nthreads, mp_mt, blocked, probe_rpt) / max(secs, 0.001)
+        rpt = max(1, int(float('%.2g' % (args.target_seconds * rate / nthreads))))
+        if max_rpt is not None and rpt > max_rpt:
+            print('#   WARNING: %s, nthreads=%d needs %d reads per thread to search for %0.1f seconds, but only %d '
+                  'are available' % (name, nthreads, rpt, args.target_seconds, max_rpt), file=sys.stderr)
+            rpt = max_rpt
+        print('#   %s, nthreads=%d: %0.1f reads/second; using %d reads per thread' %
+              (name, nthreads, rate, rpt), file=sys.stderr)
+        mkdir_quiet(os.path.dirname(calib_fn))
+        new_file = not os.path.exists(calib_fn)
+        with open(calib_fn, 'a') as fh:
+            if new_file:
+                fh.write('\t'.join(cols) + '\n')
+            fh.write('\t'.join(map(str, [nthreads, args.target_seconds, probe_rpt, '%0.3f' % secs,
+                                          '%0.1f' % rate, rpt])) + '\n')
+        ret[(name, nthreads)] = rpt
+    return ret
+
+
+def sliced_reads(args, nthreads, mp_mt, blocked, reads_per_thread):
+    """ # reads prepare_reads gives an experiment's processes in all, which
+        for blocked MP+MT runs is rounded to whole blocks rather than
+        exactly reads_per_thread * nthreads """
+    nprocess, nreads_per_process, srcs = slice_plan(args, nthreads, mp_mt, blocked, reads_per_thread)
+    bounds = slice_bounds(args, srcs[0], nprocess, nreads_per_process, mp_mt > 0 and blocked)
+    return bounds[-1] - bounds[0]
+
+
+def experiment_throughput(args, pe_str, name, mp_mt, nthreads, reads_per_thread, blocked=False):
+    """ Reads per second of search in the recorded attempt of an experiment,
+        from its .err files; 0 if the experiment failed or timed out, None
+        if it hasn't run.  The # reads is what prepare_reads actually gave
+        the processes (see sliced_reads). """
+    odir = join(args.output_dir, pe_str, name)
+    run_name = make_run_name(name, pe_str, mp_mt, 0, nthreads, 1)
+    if not os.path.exists(join(odir, run_name + '.JOIN')):
+        return None
+    if not os.path.exists(join(odir, run_name + '.SUCCEED')):
+        return 0.0
+    nprocess = 1 if mp_mt == 0 else nthreads // mp_mt
+    search_times = []
+    for i in range(nprocess):
+        search_times.append(parse_search_time(join(odir, make_run_name(name, pe_str, mp_mt, i, nthreads, 1) + '.err')))
+    if any(search_time is None or search_time <= 0 for search_time in search_times):
+        return 0.0
+    return sliced_reads(args, nthreads, mp_mt, blocked, reads_per_thread) / max(search_times)
+
+
+def refine_peak(measured, step, noise):
+    """ Given measured, a dict from thread count to throughput for one
+        config, return the thread counts to try next.  These are the
+        midpoints, rounded to a multiple of step, between the best thread
+        count so far and its measured neighbours on either side.  A side is
+        left alone once no untried multiple of step lies between, or once
+        the neighbour's throughput is within a fraction noise of the best,
+        since then the difference can't be told apart from run-to-run
+        variation. """
+    pts = sorted(measured)
+    k = max(range(len(pts)), key=lambda i: measured[pts[i]])
+    best = pts[k]
+    ret = []
+    for nb in [pts[k-1] if k > 0 else None, pts[k+1] if k + 1 < len(pts) else None]:
+        if nb is None or measured[nb] >= measured[best] * (1.0 - noise):
+            continue
+        lo, hi = min(nb, best), max(nb, best)
+        inner = list(range((lo // step + 1) * step, hi, step))
+        if len(inner) > 0:
+            ret.append(min(inner, key=lambda t: abs(2 * t - lo - hi)))
+    return ret
+
+
+def search_peaks(args, pe_str, series, run):
+    """ Instead of running every config at every thread count in series,
+        look for the thread count with peak throughput.  The first round
+        runs series as a coarse grid; each later round runs, for each
+        config, the thread counts refine_peak() suggests, until none are
+        left or --search-rounds rounds have run.  run(series, want) runs
+        the experiments for which want(nthreads, name, mp_mt) is true, as
+        ordinary runs, and returns the calibrated reads per thread.  Each
+        config's measurements are written to search.tsv in its output
+        directory. """
+    configs = [(name, mp_mt, aligner_args is not None and 'block-bytes' in aligner_args)
+               for name, _, _, mp_mt, _, aligner_args in get_configs(args.config)]
+    measured = dict((name, {}) for name, _, _ in configs)
+    rounds = dict((name, {}) for name, _, _ in configs)
+    todo = dict((name, set(t for t in series if mp_mt == 0 or t % mp_mt == 0)) for name, mp_mt, _ in configs)
+    for rnd in range(1, args.search_rounds + 1):
+        if not any(todo.values()):
+            break
+        round_series = sorted(set.union(*todo.values()))
+        print('# Peak search round %d: thread counts %s' % (rnd, str(round_series)), file=sys.stderr)
+        rpts = run(round_series, lambda nthreads, name, mp_mt: nthreads in todo[name])
+        for name, mp_mt, blocked in configs:
+            for nthreads in sorted(todo[name]):
+                rpt = rpts.get((name, nthreads), args.reads_per_thread)
+                throughput = experiment_throughput(args, pe_str, name, mp_mt, nthreads, rpt, blocked=blocked)
+                measured[name][nthreads] = throughput or 0.0
+                rounds[name][nthreads] = rnd
+                print('#   %s, nthreads=%d: %0.1f reads/second' % (name, nthreads, measured[name][nthreads]),
+                      file=sys.stderr)
+            step = args.search_step if mp_mt == 0 else mp_mt * args.search_step // math.gcd(mp_mt, args.search_step)
+            todo[name] = set()
+            if len(measured[name]) > 0:
+                todo[name] = set(refine_peak(measured[name], step, args.search_noise)) - set(measured[name])
+    for name, _, _ in configs:
+        if len(measured[name]) == 0:
+            continue
+        peak = max(measured[name], key=lambda t: measured[name][t])
+        print('# %s: peak of %0.1f reads/second at %d threads, after %d runs' %
+              (name, measured[name][peak], peak, len(measured[name])), file=sys.stderr)
+        with open(join(args.output_dir, pe_str, name, 'search.tsv'), 'w') as fh:
+            fh.write('\t'.join(['nthreads', 'round', 'reads_per_second', 'peak']) + '\n')
+            for nthreads in sorted(measured[name]):
+                fh.write('\t'.join(map(str, [nthreads, rounds[name][nthreads], '%0.1f' % measured[name][nthreads],
+                                              int(nthreads == peak)])) + '\n')
+
+
+def parse_load_times(fn):
+    """ Index load times from an aligner's stderr, found the same way
+        tabulate.py finds its refload, fwload and rvload columns """
+    ret = {'refload': None, 'fwload': None, 'rvload': None}
+    with open(fn) as fh:
+        for ln in fh:
+            if ln.startswith('Time loading reference'):
+                ret['refload'] = parse_hms(ln.split()[-1])
+            elif ln.startswith('Time loading forward index'):
+                ret['fwload'] = parse_hms(ln.split()[-1])
+            elif ln.startswith('Time loading mirror index'):
+                ret['rvload'] = parse_hms(ln.split()[-1])
+            elif ln.startswith('[bwa_idx_load] wall time'):
+                ret['fwload'] = float(ln.split()[3])
+    return ret
+
+
+def index_load_bench(args, pe_str, tmpdir, cpu_topology=None):
+    """ For each config, align a few reads on one thread with the index
+        cold and then warm in the page cache, each with and without --mm
+        (BWA-MEM has no --mm), --index-bench-reps times.  Load, search and
+        wall times go to index_load.tsv in the config's output directory. """
+    cols = ['cache', 'mm', 'rep', 'refload', 'fwload', 'rvload', 'search_time', 'wall_time']
+    bench_dir = join(tmpdir, 'index_bench', pe_str)
+    mkdir_quiet(bench_dir)
+    read_sets = {}
+    cpusets = None
+    if cpu_topology is not None:
+        cpusets = [set(c.cpu for c in topology.assign(cpu_topology, args.pin, 1, 1)[0])]
+    for name, tool, _, _, _, aligner_args in get_configs(args.config):
+        verify_index(args.index, tool)
+        blocked = aligner_args is not None and 'block-bytes' in aligner_args
+        if blocked not in read_sets:
+            rs_dir = join(bench_dir, 'b' if blocked else 'u')
+            mkdir_quiet(rs_dir)
+            read_sets[blocked] = prepare_reads(args, 1, 0, rs_dir, blocked=blocked,
+                                               reads_per_thread=args.index_bench_reads)
+        build_dir = join(args.build_dir, pe_str, name)
+        odir = join(args.output_dir, pe_str, name)
+        mkdir_quiet(odir)
+        rows = []
+        for mm in [False] if tool == 'bwa' else [False, True]:
+            for state in ['cold', 'warm']:
+                for rep in range(args.index_bench_reps):
+                    print('# %s: %s index, %s--mm, repetition %d' % (name, state, '' if mm else 'no ', rep + 1),
+                          file=sys.stderr)
+                    run_name = '%s_%s_%s_%d' % (name, state, 'mm' if mm else 'nomm', rep)
+                    efn, ofn = join(bench_dir, run_name + '.err'), join(bench_dir, run_name + '.out')
+                    cmds, ofns = aligner_cmds(args, tool, build_dir, 1, 1 if mm else 0, aligner_args,
+                                              read_sets[blocked], ['/dev/null'], [ofn])
+                    set_index_cache(args.index, tool, state)
+                    exitlevel, start, end = supervise(cmds, ofns, [efn], args.timeout, cpusets=cpusets)[0]
+                    if exitlevel != 0:
+                        raise RuntimeError('Index load benchmark of "%s" failed or timed out; see "%s"' % (name, efn))
+                    times = parse_load_times(efn)
+                    search_time = parse_search_time(efn)
+                    rows.append([state, int(mm), rep] +
+                                ['NA' if times[col] is None else '%0.3f' % times[col] for col in cols[3:6]] +
+                                ['NA' if search_time is None else '%0.3f' % search_time, '%0.3f' % (end - start)])
+                    loads = ', '.join('%s=%s' % kv for kv in zip(cols[3:6], rows[-1][3:6]))
+                    print('#   load: %s, wall: %0.3f' % (loads, end - start), file=sys.stderr)
+        with open(join(odir, 'index_load.tsv'), 'w') as fh:
+            fh.write('\t'.join(cols) + '\n')
+            for row in rows:
+                fh.write('\t'.join(map(str, row)) + '\n')
+    for read_set in read_sets.values():
+        purge_reads(read_set)
+
+
 repos = {'bowtie': 'https://github.com/BenLangmead/bowtie.git',
          'bowtie2': 'https://github.com/BenLangmead/bowtie2.git',
          'hisat': 'https://github.com/BenLangmead/hisat.git',
          'bwa': 'https://github.com/BenLangmead/bwa.git'}
 
 
+def plan_builds(args, pe_str):
+    """ Work out how to set up the binary for each config row.  Rows are
+        grouped into variants by (tool, branch, preproc).  Each variant is
+        built once, in the build directory of its first row, and later rows
+        of the same variant are symlinked to it.  Each branch is cloned
+        once; other variants of the branch start from a copy of the clone.
+        Returns a list of (name, action, detail) in config order, where
+        action is one of build, copy, pull, keep or link. """
+    plan = []
+    variant_dirs = {}  # (tool, branch, preproc) -> name of row that builds it
+    branch_dirs = {}   # (tool, branch) -> build dir of first variant
+    last_tool = None
+    for name, tool, branch, _, preproc, _ in get_configs(args.config):
+        if args.preproc is not None:
+            preproc += ' ' + args.preproc
+        if last_tool is not None:
+            assert tool == last_tool
+        last_tool = tool
+        build_dir = join(args.build_dir, pe_str, name)
+        exists = os.path.exists(build_dir) and not args.force_builds
+        variant = (tool, branch, preproc)
+        if variant in variant_dirs:
+            plan.append((name, 'keep' if exists else 'link', variant_dirs[variant]))
+        elif (tool, branch) in branch_dirs:
+            plan.append((name, ('pull' if args.pull else 'keep') if exists else 'copy', branch_dirs[(tool, branch)]))
+        else:
+            plan.append((name, ('pull' if args.pull else 'keep') if exists else 'build', branch))
+            branch_dirs[(tool, branch)] = build_dir
+        if variant not in variant_dirs:
+            variant_dirs[variant] = name
+    return plan
+
+
+def setup_binaries(args, pe_str):
+    """ Print the build plan, then carry it out: clone, copy and pull
+        serially, then run all the builds in a process pool sharing a
+        budget of --build-jobs make jobs, each logging to its own file """
+    print('# Setting up binaries', file=sys.stderr)
+    plan = plan_builds(args, pe_str)
+    rows = dict((name, (tool, branch, preproc)) for name, tool, branch, _, preproc, _ in get_configs(args.config))
+    for name, action, detail in plan:
+        print('#   %s: %s%s' % (name, action, '' if action == 'keep' else ' (%s)' % detail), file=sys.stderr)
+    log_dir = join(args.build_dir, pe_str, 'logs')
+    mkdir_quiet(log_dir)
+    makes = []
+    for name, action, detail in plan:
+        tool, branch, preproc = rows[name]
+        if args.preproc is not None:
+            preproc += ' ' + args.preproc
+        build_dir = join(args.build_dir, pe_str, name)
+        if action in ['build', 'copy', 'link'] and os.path.lexists(build_dir):
+            print('#   Removing existing "%s" subdir' % build_dir, file=sys.stderr)
+            if os.path.islink(build_dir):
+                os.remove(build_dir)
+            else:
+                shutil.rmtree(build_dir)
+        mkdir_quiet(os.path.dirname(build_dir))
+        if action == 'build':
+            print('#   Cloning "%s"' % name, file=sys.stderr)
+            install_tool_version(name, tool, repos[tool], branch, preproc, build_dir, make_tool=False)
+        elif action == 'copy':
+            print('#   Copying "%s"' % name, file=sys.stderr)
+            os.system('cp -r %s %s' % (detail, build_dir))
+            exe = os.path.join(build_dir, tool_exe(tool))
+            if os.path.exists(exe):
+                os.remove(exe)
+        elif action == 'pull':
+            print('#   Pulling "%s"' % name, file=sys.stderr)
+            os.system('cd %s && git pull' % build_dir)
+        elif action == 'link':
+            print('#   Linking "%s"' % name, file=sys.stderr)
+            os.system('ln -s -f %s %s' % (detail, build_dir))
+        if action in ['build', 'copy', 'pull']:
+            makes.append([name, tool, preproc, build_dir, 1, join(log_dir, name + '.log')])
+
+    if len(makes) > 0:
+        nworkers = max(1, min(len(makes), args.build_jobs))
+        for job in makes:
+            job[4] = max(1, args.build_jobs // nworkers)
+        print('#   Building %d variants, %d at a time with up to %d make jobs each; logs in "%s"' %
+              (len(makes), nworkers, makes[0][4], log_dir), file=sys.stderr)
+        pool = multiprocessing.Pool(nworkers)
+        try:
+            for name, secs in pool.imap_unordered(make_job, map(tuple, makes)):
+                print('#   Built "%s" in %0.1f seconds' % (name, secs), file=sys.stderr)
+        finally:
+            pool.close()
+            pool.join()
+
+    counts = dict((action, len([1 for _, act, _ in plan if act == action]))
+                  for action in ['build', 'copy', 'pull', 'link', 'keep'])
+    print('# Finished setting up binaries; built %d, copied %d, pulled %d, linked %d, kept %d' %
+          (counts['build'], counts['copy'], counts['pull'], counts['link'], counts['keep']), file=sys.stderr)
+
+
+def run_experiment(args, pe_str, tmpdir, experiment, read_set, feeds, redo, cpu_topology=None, pin='none',
+                   iostat_x=False):
+    """ Run the attempts of one experiment, (nthreads, name, tool, mp_mt,
+        aligner_args), on the prepared read_set; the last of the redo
+        attempts is the recorded one.  If cpu_topology is given, the
+        processes are pinned to its CPUs according to policy pin.  Returns
+        the run names of the recorded attempt's processes. """
+    nthreads, name, tool, mp_mt, aligner_args = experiment
+    build_dir = join(args.build_dir, pe_str, name)
+    odir = join(args.output_dir, pe_str, name)
+    nprocess = 1 if mp_mt == 0 else nthreads // mp_mt
+    assert nprocess >= 1
+    nthreads_per_process = nthreads if mp_mt == 0 else mp_mt
+    print('# %s: nthreads=%d, nprocs=%d, threads per proc=%d' %
+          (name, nthreads, nprocess, nthreads_per_process), file=sys.stderr)
+
+    for idx in range(redo):
+        idx_rev = redo - idx
+        print('# --- Attempt %d/%d ---' % (idx+1, redo))
+        if idx_rev == 1 and args.index_cache != 'warmup':
+            set_index_cache(args.index, tool, args.index_cache)
+
+        # Set up output files
+        run_names = [make_run_name(name, pe_str, mp_mt, i, nthreads, idx_rev) for i in range(nprocess)]
+        run_name = run_names[0]
+        stdout_ofns = ['/dev/null'] * nprocess
+        stderr_ofns = ['/dev/null'] * nprocess
+        sam_ofns = ['/dev/null'] * nprocess
+        if idx_rev == 1:
+            stdout_ofns = [join(odir, '%s.out' % runname) for runname in run_names]
+            stderr_ofns = [join(odir, '%s.err' % runname) for runname in run_names]
+            if not args.sam_dev_null:
+                samdir = odir if args.sam_output_dir else tmpdir
+                for runname in run_names:
+                    mkdir_quiet(join(samdir, name, pe_str, runname))
+                sam_ofns = [join(samdir, name, pe_str, runname, 'out.sam') for runname in run_names]
+
+        cmds, ofns = aligner_cmds(args, tool, build_dir, nthreads_per_process, mp_mt, aligner_args,
+                                  read_set, sam_ofns, stdout_ofns)
+
+        feeders = []
+        if args.stream_inputs:
+            for _, _, src, begin, end, fifo in feeds:
+                feeders.append(FifoFeeder(src, begin, end, fifo, decompress=args.decompress))
+                feeders[-1].start()
+        sampler, monitors = None, []
+        if procmon.available():
+            sampler = procmon.ProcSampler(join(odir, run_name), interval=args.sample_interval,
+                                          threads=args.thread_telemetry)
+        else:
+            monitors = start_monitors(join(odir, run_name), iostat_x)
+        cpusets = None
+        if cpu_topology is not None:
+            assignment = topology.assign(cpu_topology, pin, nprocess, nthreads_per_process)
+            cpusets = [set(c.cpu for c in cpus) for cpus in assignment]
+            for i, cpus in enumerate(assignment):
+                print('#   Process %d pinned to CPUs %s' % (i, topology.format_cpulist(c.cpu for c in cpus)),
+                      file=sys.stderr)
+            if idx_rev == 1:
+                topology.write_mapping(join(odir, run_name + '.pin'), pin, assignment)
+        print('#   Starting processes', file=sys.stderr)
+        results = supervise(cmds, ofns, stderr_ofns, args.timeout,
+                            on_start=None if sampler is None else sampler.add_pid,
+                            on_exit=None if sampler is None else sampler.finish_pid, cpusets=cpusets)
+        exitlevels = [exitlevel for exitlevel, _, _ in results]
+        if sampler is not None:
+            sampler.close()
+            print('#   Took %d resource samples' % sampler.nsamples, file=sys.stderr)
+        for monitor, ofh in monitors:
+            print('#   Killing %s proc with pid %d' % (monitor.args[0], monitor.pid), file=sys.stderr)
+            monitor.kill()
+            monitor.wait()
+            ofh.close()
+        for feeder in feeders:
+            feeder.abort()
+        starts = [start for _, start, _ in results]
+        ends = [end for _, _, end in results]
+        print('#   All processes joined; took %f seconds, with %f seconds between first and last to finish' %
+              (max(ends) - min(starts), max(ends) - min(ends)), file=sys.stderr)
+        if idx_rev == 1:
+            for runname, (exitlevel, start, end) in zip(run_names, results):
+                write_wall_times(join(odir, runname + '.wall'), exitlevel, start, end, starts, ends,
+                                 index_cache=None if args.index_cache == 'warmup' else args.index_cache)
+        if len(feeders) > 0:
+            feed_sec = max(feeder.summary()[1] for feeder in feeders)
+            feed_bytes = sum(feeder.nbytes for feeder in feeders)
+            print('#   Feeders streamed %d bytes in %f seconds (%0.2f MB/s)' %
+                  (feed_bytes, feed_sec, feed_bytes / max(feed_sec, 1e-6) / (1024.0 * 1024.0)),
+                  file=sys.stderr)
+            if idx_rev == 1:
+                write_feed_summary(feeders, feeds, join(odir, run_name + '.feed'))
+        # an aligner fed less than its whole slice can still exit cleanly
+        feed_errors = [feeder.status for feeder in feeders if feeder.status != 'done']
+        for status in feed_errors:
+            print('#   Feeder did not finish: %s' % status, file=sys.stderr)
+        os.system('touch ' + os.path.join(odir, run_name + '.JOIN'))
+        if any(map(lambda x: x is None, exitlevels)):
+            print('#   At least one subprocess timed out', file=sys.stderr)
+            os.system('touch ' + os.path.join(odir, run_name + '.TIME_OUT'))
+        elif any(map(lambda x: x != 0, exitlevels)) or len(feed_errors) > 0:
+            os.system('touch ' + os.path.join(odir, run_name + '.FAIL'))
+            if args.stop_on_fail:
+                raise RuntimeError('At least one subprocess exited with non-zero exit level or was not fed all '
+                                   'of its reads. Exit levels: %s; feeders: %s' % (str(exitlevels), str(feed_errors)))
+        else:
+            os.system('touch ' + os.path.join(odir, run_name + '.SUCCEED'))
+
+        if args.delete_sam:
+            print('#   Deleting SAM outputs', file=sys.stderr)
+            for sam_ofn in sam_ofns:
+                if sam_ofn != '/dev/null':
+                    os.remove(sam_ofn)
+    return run_names
+
+
+def prepare_read_set(args, pe_str, tmpdir, spec, cache=None):
+    """ Prepare the read set described by spec, an element of the read-set
+        list from experiment_plan; returns the read set and, with
+        --stream-inputs, the feeds for it """
+    rs_nthreads, rs_mp_mt, rs_blocked, rs_name, rs_rpt = spec
+    print('#   Preparing reads (%s) for nthreads=%d, mp_mt=%d, reads per thread=%d' %
+          ('blocked' if rs_blocked else 'unblocked', rs_nthreads, rs_mp_mt, rs_rpt), file=sys.stderr)
+    # each read set gets its own directory, so that the next can be
+    # prepared while the current one is in use
+    rs_dir = join(tmpdir, rs_name, pe_str, '%d_%d_%s_%d' % (rs_nthreads, rs_mp_mt, 'b' if rs_blocked else 'u', rs_rpt))
+    mkdir_quiet(rs_dir)
+    if args.stream_inputs:
+        return prepare_streams(args, rs_nthreads, rs_mp_mt, rs_dir, blocked=rs_blocked, reads_per_thread=rs_rpt)
+    return prepare_reads(args, rs_nthreads, rs_mp_mt, rs_dir, blocked=rs_blocked, cache=cache,
+                         reads_per_thread=rs_rpt), None
+
+
+def run_plan(args, pe_str, tmpdir, plan, read_set_plan, cache=None, cpu_topology=None, iostat_x=False):
+    """ Run the experiments in plan, as returned by experiment_plan, preparing
+        the read sets in read_set_plan as they're needed """
+    indexes_verified = set()
+    read_set, feeds = None, None
+
+    def _prepare(i):
+        return prepare_read_set(args, pe_str, tmpdir, read_set_plan[i], cache=cache)
+
+    preparer = None
+    if args.prepare_ahead and not args.stream_inputs:
+        preparer = ReadPreparer(_prepare, nice=args.prepare_nice, ioclass=args.prepare_ioclass)
+
+    last_rs = None
+
+    # iterate over numbers of threads, then configurations
+    for nthreads, name, tool, mp_mt, aligner_args, blocked, rs in plan:
+        odir = join(args.output_dir, pe_str, name)
+        if not os.path.exists(odir):
+            print('#   Creating output directory "%s"' % odir, file=sys.stderr)
+            mkdir_quiet(odir)
+
+        redo = 1
+
+        if tool not in indexes_verified:
+            print('#   Verifying index for ' + tool, file=sys.stderr)
+            verify_index(args.index, tool)
+            indexes_verified.add(tool)
+            redo = 2
+
+        if rs != last_rs:
+            print('#   Purging some old reads', file=sys.stderr)
+            purge_reads(read_set, cache)
+            if preparer is not None:
+                read_set, feeds = preparer.take(rs)
+                if rs + 1 < len(read_set_plan):
+                    preparer.submit(rs + 1)
+            else:
+                read_set, feeds = _prepare(rs)
+            redo = 2
+            last_rs = rs
+
+        if args.index_cache != 'warmup':
+            redo = 1  # page cache is set up explicitly, no warm-up attempt needed
+
+        run_experiment(args, pe_str, tmpdir, (nthreads, name, tool, mp_mt, aligner_args), read_set, feeds, redo,
+                       cpu_topology=cpu_topology, pin=args.pin, iostat_x=iostat_x)
+
+    print('#   Purging some old reads', file=sys.stderr)
+    purge_reads(read_set, cache)
+    if preparer is not None:
+        preparer.abandon(lambda rs_feeds: purge_reads(rs_feeds[0], cache))
+
+
+def write_pack_info(ofn, cpus, neighbours):
+    """ Record, for tabulate.py, which CPUs a packed run had to itself and
+        which other runs overlapped it in time """
+    with open(ofn, 'w') as fh:
+        fh.write('coscheduled: %d\n' % len(neighbours))
+        fh.write('cpus: %s\n' % topology.format_cpulist(c.cpu for c in cpus))
+        fh.write('neighbours: %s\n' % ' '.join(sorted(neighbours)))
+
+
+def run_packed(args, pe_str, tmpdir, plan, read_set_plan, cpu_topology, cache=None, iostat_x=False):
+    """ Like run_plan, but treat plan as a queue and run experiments
+        concurrently when their threads fit on the node together.  Each run
+        gets whole cores to itself, ceil(nthreads / --pack-threads-per-core)
+        of them or more if that many cores have fewer than nthreads CPUs,
+        taken in compact order so a run stays within a NUMA node
+        where it can, and its processes are pinned within those cores with
+        the --pin policy (scatter if none).  Runs with at least
+        --pack-exclusive-threads threads have the node to themselves.
+        Experiments start in plan order, except that a run that doesn't fit
+        yet lets later runs that do fit go ahead of it.  Read sets are only
+        cut (and purged) while nothing is running: whenever the node is
+        idle, the read sets for everything that fits are prepared, and while
+        runs are going only experiments whose read sets are ready can fill
+        freed cores.  Each recorded run gets a .pack file saying how many
+        other runs overlapped it. """
+    if args.stream_inputs:
+        raise RuntimeError('--pack-runs and --stream-inputs are mutually exclusive')
+    if args.index_cache == 'cold':
+        raise RuntimeError('--pack-runs and --index-cache cold are mutually exclusive; evicting the index would '
+                           'disturb concurrent runs')
+    cores = {}
+    for c in topology.compact_order(cpu_topology):
+        cores.setdefault((c.node, c.package, c.core), []).append(c)
+    core_order = list(cores)
+    free = list(core_order)
+    policy = 'scatter' if args.pin == 'none' else args.pin
+    users = {}  # read set -> # experiments that still need it
+    for experiment in plan:
+        users[experiment[-1]] = users.get(experiment[-1], 0) + 1
+    prepared = {}  # read set -> (read set, feeds)
+    fresh = set()  # prepared read sets no experiment has used yet
+    indexes_verified = set()
+    queue = list(plan)
+    running = {}  # key -> [thread, experiment, taken cores, neighbour keys, exclusive]
+    done = []
+    done_cond = threading.Condition()
+    errors = []
+
+    def _take(nthreads, free):
+        """ Cores, from the front of free, for a run with nthreads threads:
+            at least one per --pack-threads-per-core threads, and enough
+            that they have a CPU per thread; None if free has too few """
+        taken, ncpus = [], 0
+        for core in free:
+            if len(taken) >= -(-nthreads // args.pack_threads_per_core) and ncpus >= nthreads:
+                break
+            taken.append(core)
+            ncpus += len(cores[core])
+        if ncpus < nthreads or len(taken) < min(len(core_order), -(-nthreads // args.pack_threads_per_core)):
+            return None
+        return taken
+
+    for experiment in queue:
+        if _take(experiment[0], core_order) is None:
+            raise RuntimeError('%s with %d threads needs more CPUs than the %d available' %
+                               (experiment[1], experiment[0], len(cpu_topology)))
+
+    def _worker(key, experiment, read_set, feeds, redo, cpus):
+        try:
+            run_names = run_experiment(args, pe_str, tmpdir, experiment[:5], read_set, feeds, redo,
+                                       cpu_topology=cpus, pin=policy, iostat_x=iostat_x)
+        except Exception as e:
+            run_names = None
+            errors.append(e)
+        with done_cond:
+            done.append((key, run_names))
+            done_cond.notify()
+
+    def _select(ready):
+        """ Queued experiments to start now, with the cores each would get;
+            only experiments for which ready(read set) is true are chosen """
+        ret, avail = [], free
+        if any(run[4] for run in running.values()):
+            return ret
+        for experiment in queue:
+            nthreads, rs = experiment[0], experiment[-1]
+            exclusive = 0 < args.pack_exclusive_threads <= nthreads
+            if exclusive and (len(running) > 0 or len(ret) > 0):
+                break  # wait for the node to empty rather than let later runs overtake
+            taken = _take(nthreads, avail)
+            if taken is None or not ready(rs):
+                continue
+            ret.append((experiment, taken))
+            avail = avail[len(taken):]
+            if exclusive:
+                break
+        return ret
+
+    print('# Packing %d experiments onto %d cores' % (len(queue), len(core_order)), file=sys.stderr)
+    to_purge = []
+    while len(queue) > 0 or len(running) > 0:
+        if len(errors) == 0:
+            if len(running) == 0:
+                # slices are only cut and purged while no run is being timed
+                for rs in to_purge:
+                    print('#   Purging reads for read set %d' % rs, file=sys.stderr)
+                    purge_reads(prepared.pop(rs)[0], cache)
+                to_purge = []
+                for experiment, _ in _select(lambda rs: True):
+                    rs = experiment[-1]
+                    if rs not in prepared:
+                        prepared[rs] = prepare_read_set(args, pe_str, tmpdir, read_set_plan[rs], cache=cache)
+                        fresh.add(rs)
+            for experiment, taken in _select(lambda rs: rs in prepared):
+                nthreads, name, tool, mp_mt, _, _, rs = experiment
+                exclusive = 0 < args.pack_exclusive_threads <= nthreads
+                queue.remove(experiment)
+                free = [core for core in free if core not in taken]
+                odir = join(args.output_dir, pe_str, name)
+                mkdir_quiet(odir)
+                redo = 1
+                if tool not in indexes_verified:
+                    print('#   Verifying index for ' + tool, file=sys.stderr)
+                    verify_index(args.index, tool)
+                    indexes_verified.add(tool)
+                    redo = 2
+                if rs in fresh:
+                    fresh.discard(rs)
+                    redo = 2
+                if args.index_cache != 'warmup':
+                    redo = 1
+                cpus = [c for core in taken for c in cores[core]]
+                key = '%s_%d' % (name, nthreads)
+                neighbours = set(running)
+                for run in running.values():
+                    run[3].add(key)
+                print('# Starting %s with %d threads on CPUs %s alongside %d other run(s)' %
+                      (name, nthreads, topology.format_cpulist(c.cpu for c in cpus), len(running)), file=sys.stderr)
+                thread = threading.Thread(target=_worker, args=(key, experiment, prepared[rs][0], prepared[rs][1],
+                                                                redo, cpus))
+                running[key] = [thread, experiment, taken, neighbours, exclusive]
+                thread.start()
+        if len(running) == 0:
+            if len(errors) > 0 or len(queue) == 0:
+                break
+            raise RuntimeError('Experiment %s with %d threads can never start on %d cores' %
+                               (queue[0][1], queue[0][0], len(core_order)))
+        with done_cond:
+            while len(done) == 0:
+                done_cond.wait()
+            key, run_names = done.pop(0)
+        thread, experiment, taken, neighbours, _ = running.pop(key)
+        thread.join()
+        free = sorted(free + taken, key=core_order.index)
+        rs = experiment[-1]
+        users[rs] -= 1
+        if users[rs] == 0:
+            to_purge.append(rs)
+        if run_names is not None:
+            odir = join(args.output_dir, pe_str, experiment[1])
+            cpus = [c for core in taken for c in cores[core]]
+            for run_name in run_names:
+                write_pack_info(join(odir, run_name + '.pack'), cpus, neighbours)
+            print('# Finished %s with %d threads; %d other run(s) overlapped it' %
+                  (experiment[1], experiment[0], len(neighbours)), file=sys.stderr)
+    for read_set, _ in prepared.values():
+        purge_reads(read_set, cache)
+    if len(errors) > 0:
+        raise errors[0]
+
+
 def go(args):
     pe_str = 'pe' if args.m2 is not None else 'unp'
 
@@ -239,53 +1730,7 @@ def go(args):
         print('# Creating output directory "%s"' % args.output_dir, file=sys.stderr)
         mkdir_quiet(args.output_dir)
 
-    print('# Setting up binaries', file=sys.stderr)
-    last_name, last_tool, last_branch, last_preproc, last_build_dir = '', '', '', '', ''
-    npull, nbuild, ncopy, nlink = 0, 0, 0, 0
-    for name, tool, branch, _, preproc, _ in get_configs(args.config):
-        if args.preproc is not None:
-            preproc += ' ' + args.preproc
-        if name == 'name' and branch == 'branch':
-            continue  # skip header line
-        if len(last_tool) == 0:
-            last_tool = tool
-        assert tool == last_tool
-        build, pull = False, False
-        build_dir = join(args.build_dir, pe_str, name)
-        if os.path.exists(build_dir) and args.force_builds:
-            print('#   Removing existing "%s" subdir because of --force' % build_dir, file=sys.stderr)
-            shutil.rmtree(build_dir)
-            build = True
-        elif os.path.exists(build_dir):
-            pull = True
-        elif not os.path.exists(build_dir):
-            build = True
-
-        if pull and args.pull:
-            npull += 1
-            print('#   Pulling "%s"' % name, file=sys.stderr)
-            os.system('cd %s && git pull' % build_dir)
-            make_tool_version(name, tool, preproc, build_dir)
-        elif build and tool == last_tool and branch == last_branch and preproc == last_preproc:
-            nlink += 1
-            print('#   Linking "%s"' % name, file=sys.stderr)
-            mkdir_quiet(os.path.dirname(build_dir))
-            os.system('ln -s -f %s %s' % (last_name, build_dir))
-        elif build and tool == last_tool and branch == last_branch:
-            ncopy += 1
-            print('#   Copying "%s"' % name, file=sys.stderr)
-            mkdir_quiet(os.path.dirname(build_dir))
-            os.system('cp -r %s %s' % (last_build_dir, build_dir))
-            os.remove(os.path.join(build_dir, tool_exe(tool)))
-            make_tool_version(name, tool, preproc, build_dir)
-        elif build:
-            nbuild += 1
-            print('#   Building "%s"' % name, file=sys.stderr)
-            install_tool_version(name, tool, repos[tool], branch, preproc, build_dir)
-        last_name, last_tool, last_branch, last_preproc, last_build_dir = name, tool, branch, preproc, build_dir
-
-    print('# Finished setting up binaries; built %d, pulled %d, copied %d, linked %d' %
-          (nbuild, npull, ncopy, nlink), file=sys.stderr)
+    setup_binaries(args, pe_str)
 
     series = list(map(int, args.nthread_series.split(',')))
     assert len(series) > 0
@@ -294,214 +1739,100 @@ def go(args):
     print('# Verifying reads', file=sys.stderr)
     verify_reads([args.m1, args.m2, args.m1b, args.m2b])
 
+    nreads_tot = None
     if not args.no_count:
         print('# Counting total # reads', file=sys.stderr)
-        nlines_tot = wcl(args.m1)
-        nlines_tot_b = wcl(args.m1b)
-        #if nlines_tot != nlines_tot_b:
-        #    raise RuntimeError('Mismatch in # lines between unblocked (%d) and blocked (%d) inputs' % \
-        #                       (nlines_tot, nlines_tot_b))
+        nreads_tot = count_reads(args.m1, decompress=args.decompress)
+        nreads_tot_b = count_reads(args.m1b, decompress=args.decompress)
+        #if nreads_tot != nreads_tot_b:
+        #    raise RuntimeError('Mismatch in # reads between unblocked (%d) and blocked (%d) inputs' % \
+        #                       (nreads_tot, nreads_tot_b))
 
-        nreads_tot = nlines_tot // 4
         print('# Count = %d' % nreads_tot, file=sys.stderr)
 
         nreads_needed = args.reads_per_thread * max(series)
-        if nreads_needed > nreads_tot:
+        if args.target_seconds <= 0 and nreads_needed > nreads_tot:
             raise RuntimeError('# reads required for biggest experiment (%d) exceeds number of input reads (%d)'
                                % (nreads_needed, nreads_tot))
 
     print('# Generating %scommands' % ('' if args.dry_run else 'and running '), file=sys.stderr)
 
-    indexes_verified = set()
-
-    read_set = None
+    if args.stream_inputs and args.slice_cache_gb > 0:
+        raise RuntimeError('--stream-inputs and --slice-cache-gb are mutually exclusive')
+
+    cache = None
+    if args.slice_cache_gb > 0:
+        cache = SliceCache(join(tmpdir, 'slice_cache'), int(args.slice_cache_gb * 1024 * 1024 * 1024))
+        print('# Using slice cache in "%s" with %d bytes already cached' %
+              (cache.dr, sum(nbytes for _, nbytes, _ in cache.entries())), file=sys.stderr)
+
+    cpu_topology = None
+    if args.pin != 'none' or args.pack_runs:
+        cpu_topology = topology.read_topology()
+        print('# Pinning with policy "%s" to %d CPUs on %d NUMA node(s)' %
+              ('scatter' if args.pin == 'none' else args.pin, len(cpu_topology),
+               len(set(c.node for c in cpu_topology))), file=sys.stderr)
+    if args.pin != 'none':
+        # the biggest run of each config is the hardest to place; fail now
+        # rather than partway through the series
+        nthreads = max(series)
+        for name, _, _, mp_mt, _, _ in get_configs(args.config):
+            try:
+                topology.assign(cpu_topology, args.pin, 1 if mp_mt == 0 else nthreads // mp_mt,
+                                nthreads if mp_mt == 0 else mp_mt)
+            except RuntimeError as e:
+                raise RuntimeError('Can\'t pin %s with %d threads: %s' % (name, nthreads, e))
 
     iostat_x = os.system("iostat --help 2>&1 | grep -q '\-x'") == 0
 
-    # iterate over numbers of threads
-    for nthreads in series:
-
-        last_mp_mt, last_blocked = None, False
-
-        # iterate over configurations
-        for name, tool, branch, mp_mt, preproc, aligner_args in get_configs(args.config):
-            build_dir = join(args.build_dir, pe_str, name)
-
-            odir = join(args.output_dir, pe_str, name)
-            if not os.path.exists(odir):
-                print('#   Creating output directory "%s"' % odir, file=sys.stderr)
-                mkdir_quiet(odir)
-
-            redo = 1
-
-            if tool not in indexes_verified:
-                print('#   Verifying index for ' + tool, file=sys.stderr)
+    if args.index_load_bench:
+        print('# Benchmarking index loading', file=sys.stderr)
+        index_load_bench(args, pe_str, tmpdir, cpu_topology)
+        return
+
+    def _completed(nthreads, name, mp_mt):
+        run_name = make_run_name(name, pe_str, mp_mt, 0, nthreads, 1)
+        return os.path.exists(join(args.output_dir, pe_str, name, run_name + '.SUCCEED'))
+
+    rpts = {}  # (name, nthreads) -> reads per thread chosen by calibrate()
+
+    def _run(series, want=None):
+        """ Run the experiments for series, leaving out those that want()
+            rejects and, with --resume, those that already succeeded """
+        def _skip(nthreads, name, mp_mt):
+            if want is not None and not want(nthreads, name, mp_mt):
+                return True
+            return args.resume and _completed(nthreads, name, mp_mt)
+
+        plan, read_set_plan = experiment_plan(args, series, skip=_skip)
+        if args.target_seconds > 0:
+            print('# Calibrating reads per thread for %0.1f seconds of searching' % args.target_seconds,
+                  file=sys.stderr)
+            for tool in sorted(set(experiment[2] for experiment in plan)):
                 verify_index(args.index, tool)
-                indexes_verified.add(tool)
-                redo = 2
-
-            if mp_mt != 0 and (nthreads % mp_mt != 0):
-                continue  # skip experiment if # threads isn't evenly divisible
-
-            blocked = aligner_args is not None and 'block-bytes' in aligner_args
-            if last_mp_mt is None or mp_mt != last_mp_mt or blocked != last_blocked:
-                # Purge previous read set?
-                print('#   Purging some old reads', file=sys.stderr)
-                if read_set is not None:
-                    for read_list in read_set:
-                        for read_fn in read_list:
-                            os.remove(read_fn)
-                blocked_str = 'blocked' if blocked else 'unblocked'
-                print('#   Preparing reads (%s) for nthreads=%d, mp_mt=%d' %
-                      (blocked_str, nthreads, mp_mt), file=sys.stderr)
-                mkdir_quiet(join(tmpdir, name, pe_str))
-                read_set = prepare_reads(args, nthreads, mp_mt, join(tmpdir, name, pe_str), blocked=blocked)
-                redo = 2
-                last_mp_mt = mp_mt
-
-            last_blocked = blocked
-
-            nprocess = 1 if mp_mt == 0 else nthreads // mp_mt
-            assert nprocess >= 1
-            nthreads_per_process = nthreads if mp_mt == 0 else mp_mt
-            print('# %s: nthreads=%d, nprocs=%d, threads per proc=%d' %
-                  (name, nthreads, nprocess, nthreads_per_process), file=sys.stderr)
-
-            for idx in range(redo):
-                idx_rev = redo - idx
-                print('# --- Attempt %d/%d ---' % (idx+1, redo))
-
-                # Set up output files
-                run_names = ['%s_%s_%d_%d_%d_%d' % (name, pe_str, mp_mt, i, nthreads, idx_rev) for i in range(nprocess)]
-                run_name = run_names[0]
-                stdout_ofns = ['/dev/null'] * nprocess
-                stderr_ofns = ['/dev/null'] * nprocess
-                sam_ofns = ['/dev/null'] * nprocess
-                if idx_rev == 1:
-                    stdout_ofns = [join(odir, '%s.out' % runname) for runname in run_names]
-                    stderr_ofns = [join(odir, '%s.err' % runname) for runname in run_names]
-                    if not args.sam_dev_null:
-                        samdir = odir if args.sam_output_dir else tmpdir
-                        for runname in run_names:
-                            mkdir_quiet(join(samdir, name, pe_str, runname))
-                        sam_ofns = [join(samdir, name, pe_str, runname, 'out.sam') for runname in run_names]
-
-                def spawn_worker(cmd_list, ofn, efn):
-                    def worker(done_val):
-                        with open(ofn, 'wb') as ofh:
-                            with open(efn, 'wb') as efh:
-                                print(' '.join(cmd_list))
-                                proc = subprocess.Popen(cmd_list, stdout=ofh, stderr=efh)
-                                while proc.poll() is None:
-                                    time.sleep(1)
-                                    if done_val.value > 0:
-                                        os.kill(proc.pid, signal.SIGTERM)
-                                        break
-
-                    return worker
-
-                procs = []
-                done_val = multiprocessing.Value('i', 0)
-                if tool == 'bwa':
-                    for i in range(nprocess):
-                        cmd = ['%s/%s' % (build_dir, tool_exe(tool)), 'mem']
-                        cmd.extend(['-t' , str(nthreads_per_process)])
-                        if aligner_args is not None and len(aligner_args) > 0:
-                            cmd.extend(aligner_args.split())
-                        cmd.append(args.index)
-                        cmd.append(read_set[i][0])
-                        if args.m2 is not None:
-                            cmd.append(read_set[i][1])
-                        procs.append(multiprocessing.Process(target=spawn_worker(cmd, sam_ofns[i], stderr_ofns[i]), args=(done_val,)))
-                else:
-                    for i in range(nprocess):
-                        cmd = ['%s/%s' % (build_dir, tool_exe(tool))]
-                        cmd.extend(['-p', str(nthreads_per_process)])
-                        if aligner_args is not None and len(aligner_args) > 0:
-                            cmd.extend(aligner_args.split())
-                        if tool == 'bowtie2' or tool == 'hisat':
-                            cmd.append('-x')
-                        cmd.append(args.index)
-                        cmd.append('-t')
-                        if mp_mt > 0:
-                            cmd.append('--mm')
-                        if args.m2 is not None:
-                            cmd.extend(['-1', read_set[i][0]])
-                            cmd.extend(['-2', read_set[i][1]])
-                        elif tool == 'bowtie2' or tool == 'hisat':
-                            cmd.extend(['-U', read_set[i][0]])
-                        else:
-                            cmd.append(read_set[i][0])
-
-                        cmd.extend(['-S', sam_ofns[i]])
-                        procs.append(multiprocessing.Process(target=spawn_worker(cmd, stdout_ofns[i], stderr_ofns[i]), args=(done_val,)))
-
-                iostat_cmd = ['iostat']
-                if iostat_x:
-                    iostat_cmd.append('-x')
-                iostat_cmd.append('2')
-                iostat_fn = os.path.join(odir, run_name + '.iostat')
-
-                if sys.platform == 'darwin':
-                    top_cmd = 'top -l 0 -s 2'.split()
-                else:
-                    top_cmd = 'top -b -d 2'.split()
-                top_fn = os.path.join(odir, run_name + '.top')
-
-                with open(top_fn, 'w') as top_ofh:
-                    with open(iostat_fn, 'w') as iostat_ofh:
-                        iostat, top = None, None
-                        if os.system('which iostat >/dev/null 2>/dev/null') == 0:
-                            iostat = subprocess.Popen(iostat_cmd, stdout=iostat_ofh, stderr=iostat_ofh)
-                        if os.system('which top >/dev/null 2>/dev/null') == 0:
-                            top = subprocess.Popen(top_cmd, stdout=top_ofh, stderr=top_ofh)
-                        print('#   Starting processes', file=sys.stderr)
-                        ti = datetime.datetime.now()
-                        for proc in procs:
-                            proc.start()
-                        exitlevels = []
-                        for proc in procs:
-                            proc.join(args.timeout)
-                            if proc.is_alive():
-                                print('#   Process still alive after %d seconds; terminating all processes' % args.timeout,
-                                      file=sys.stderr)
-                                done_val.value = 1
-                                for p2 in procs:
-                                    p2.join()
-                                exitlevels.append(None)
-                            else:
-                                exitlevels.append(proc.exitcode)
-                        if iostat is not None:
-                            print('#   Killing iostat proc with pid %d' % iostat.pid, file=sys.stderr)
-                            iostat.kill()
-                        if top is not None:
-                            print('#   Killing top proc with pid %d' % top.pid, file=sys.stderr)
-                            top.kill()
-                        delt = datetime.datetime.now() - ti
-                print('#   All processes joined; took %f seconds' % delt.total_seconds(), file=sys.stderr)
-                os.system('touch ' + os.path.join(odir, run_name + '.JOIN'))
-                if any(map(lambda x: x is None, exitlevels)):
-                    print('#   At least one subprocess timed out', file=sys.stderr)
-                    os.system('touch ' + os.path.join(odir, run_name + '.TIME_OUT'))
-                elif any(map(lambda x: x != 0, exitlevels)):
-                    os.system('touch ' + os.path.join(odir, run_name + '.FAIL'))
-                    if args.stop_on_fail:
-                        raise RuntimeError('At least one subprocess exited with non-zero exit level. '
-                                           'Exit levels: %s' % str(exitlevels))
-                else:
-                    os.system('touch ' + os.path.join(odir, run_name + '.SUCCEED'))
+            rpts.update(calibrate(args, pe_str, tmpdir, plan, nreads_tot, cpu_topology))
+            plan, read_set_plan = experiment_plan(args, series, skip=_skip, reads_per_thread=rpts)
+        if args.resume:
+            nall = len(experiment_plan(args, series, skip=None if want is None else
+                                       lambda nthreads, name, mp_mt: not want(nthreads, name, mp_mt))[0])
+            print('# Resuming: skipping %d of %d experiments that already succeeded; %d read sets to prepare' %
+                  (nall - len(plan), nall, len(read_set_plan)), file=sys.stderr)
+
+        if args.pack_runs:
+            run_packed(args, pe_str, tmpdir, plan, read_set_plan, cpu_topology, cache=cache, iostat_x=iostat_x)
+        else:
+            run_plan(args, pe_str, tmpdir, plan, read_set_plan, cache=cache, cpu_topology=cpu_topology,
+                     iostat_x=iostat_x)
+        return rpts
 
-                if args.delete_sam:
-                    print('#   Deleting SAM outputs', file=sys.stderr)
-                    for sam_ofn in sam_ofns:
-                        if sam_ofn != '/dev/null':
-                            os.remove(sam_ofn)
+    if args.search_peak:
+        search_peaks(args, pe_str, series, _run)
+    else:
+        _run(series)
 
-    print('#   Purging some old reads', file=sys.stderr)
-    if read_set is not None:
-        for read_list in read_set:
-            for read_fn in read_list:
-                os.remove(read_fn)
+    if cache is not None:
+        print('# Slice cache: %d hits, %d misses, %d bytes of slicing avoided' %
+              (cache.nhit, cache.nmiss, cache.hit_bytes), file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -534,7 +1865,8 @@ if __name__ == '__main__':
     parser.add_argument('--input-reads-per-block', metavar='int', type=int, default=70,  # 44 for 100 bp reads
                         help='# reads in each input block')
     parser.add_argument('--timeout', metavar='int', type=int, default=1200,  # 20 minutes
-                        help='time out after N seconds')
+                        help='time out after N seconds, counted from the start of a run and applied to all of '
+                             'its processes at once')
     parser.add_argument('--nthread-series', metavar='int,int,...', type=str, required=False,
                         help='Series of comma-separated ints giving the number of threads to use. '
                              'E.g. --nthread-series 10,20,30 will run separate experiments using '
@@ -549,6 +1881,8 @@ if __name__ == '__main__':
                         help='Add preprocessing macros to be added to all build jobs.')
     parser.add_argument('--force-builds', action='store_const', const=True, default=False,
                         help='Overwrite binaries that already exist')
+    parser.add_argument('--build-jobs', metavar='int', type=int, default=multiprocessing.cpu_count(),
+                        help='Total # make jobs to run at once across all builds (default: # CPUs)')
     parser.add_argument('--pull', action='store_const', const=True, default=False,
                         help='git pull into existing build directories (note: some might be tags rather than branches)')
     parser.add_argument('--dry-run', action='store_const', const=True, default=False,
@@ -562,11 +1896,93 @@ if __name__ == '__main__':
     parser.add_argument('--delete-sam', action='store_const', const=True, default=False,
                         help='Delete SAM file as soon as aligner finishes; useful if you need to avoid exhausting a '
                              'partition')
+    parser.add_argument('--sample-interval', metavar='float', type=float, default=0.5,
+                        help='Seconds between samples of the aligner processes\' CPU, memory and I/O and of disk '
+                             'activity, written to .proc.csv and .disk.csv files next to the .out files (default: '
+                             '0.5).  Systems without /proc get top and iostat output instead.')
+    parser.add_argument('--thread-telemetry', action='store_const', const=True, default=False,
+                        help='Also sample every aligner thread from /proc/<pid>/task and write per-thread CPU '
+                             'time, context switches and CPU migrations to a .threads.tsv file next to the .out '
+                             'file')
+    parser.add_argument('--pin', metavar='policy', type=str, default='none',
+                        choices=['none'] + topology.POLICIES,
+                        help='Pin each aligner process to its own set of CPUs: "compact" fills cores and sockets '
+                             'in order, "scatter" spreads threads over all cores and NUMA nodes before using SMT '
+                             'siblings, "numa" puts each process on its own NUMA node.  The mapping is written '
+                             'to a .pin file next to the .out file.  Default: none (kernel decides)')
+    parser.add_argument('--pack-runs', action='store_const', const=True, default=False,
+                        help='Run experiments concurrently when their threads fit on the node together, each '
+                             'pinned to its own cores.  Each recorded run gets a .pack file saying how many other '
+                             'runs overlapped it.  Note that without --mm each run loads its own copy of the index')
+    parser.add_argument('--pack-threads-per-core', metavar='int', type=int, default=1,
+                        help='With --pack-runs, give each run one core per this many threads (default: 1)')
+    parser.add_argument('--pack-exclusive-threads', metavar='int', type=int, default=0,
+                        help='With --pack-runs, runs with at least this many threads have the node to themselves '
+                             '(default: 0, meaning no run is exclusive)')
+    parser.add_argument('--resume', action='store_const', const=True, default=False,
+                        help='Skip experiments whose recorded attempt already has a .SUCCEED marker in '
+                             '--output-dir, and don\'t prepare reads only they would use.  Failed and timed-out '
+                             'experiments are run again.')
     parser.add_argument('--stop-on-fail', action='store_const', const=True, default=False,
                         help='Raise exception whenever any subprocess fails')
     parser.add_argument('--no-count', action='store_const', const=True, default=False,
-                        help='Don\'t count reads at the beginning (can be slow)')
+                        help='Don\'t count reads at the beginning (can be slow for inputs without a .fqi index)')
+    parser.add_argument('--decompress', metavar='mode', type=str, default='inline',
+                        choices=fastq.DECOMPRESS_MODES,
+                        help='How to decompress gzipped read inputs when counting and slicing: inline, in a '
+                             'background thread, or in a "gzip -dc" subprocess')
+    parser.add_argument('--stream-inputs', action='store_const', const=True, default=False,
+                        help='Instead of writing read slices to --tempdir, give each aligner process named pipes '
+                             'that are fed from --m1/--m2 (or the blocked files) while it runs.  Feeder throughput '
+                             'is written to a .feed file next to the .out file.')
+    parser.add_argument('--prepare-ahead', action='store_const', const=True, default=False,
+                        help='Prepare the next read set on a background thread while the current run executes.  '
+                             'Needs room in --tempdir for two read sets.')
+    parser.add_argument('--prepare-nice', metavar='int', type=int, default=19,
+                        help='CPU niceness of the background preparer (default: 19)')
+    parser.add_argument('--prepare-ioclass', metavar='class', type=str, default='idle',
+                        choices=sorted(IOPRIO_CLASSES.keys()),
+                        help='I/O scheduling class of the background preparer, as with ionice (default: idle)')
+    parser.add_argument('--slice-jobs', metavar='int', type=int, default=1,
+                        help='Cut up to this many per-process read slices at once')
+    parser.add_argument('--slice-cache-gb', metavar='float', type=float, default=0,
+                        help='Keep prepared read slices in a cache under --tempdir, using at most this many GB and '
+                             'evicting the least recently used slices, so configurations and later runs needing '
+                             'the same slice reuse it.  Default: 0 (no cache; slices are rebuilt each time)')
+    parser.add_argument('--index-cache', metavar='state', type=str, default='warmup',
+                        choices=['warmup', 'cold', 'warm'],
+                        help='How to prepare the index in the page cache before each run.  "warmup" does an '
+                             'unrecorded warm-up run first when the index or reads change; "cold" evicts the index '
+                             'files with posix_fadvise(DONTNEED); "warm" maps them with madvise(WILLNEED) and '
+                             'touches every page.  The latter two skip the warm-up run and record the state in '
+                             'the .wall file.  Default: warmup')
+    parser.add_argument('--index-load-bench', action='store_const', const=True, default=False,
+                        help='Instead of the thread series, time index loading for each config with the index cold '
+                             'and warm in the page cache, with and without --mm; results are in index_load.tsv')
+    parser.add_argument('--index-bench-reads', metavar='int', type=int, default=100,
+                        help='# reads to align in each --index-load-bench run (default: 100)')
+    parser.add_argument('--index-bench-reps', metavar='int', type=int, default=3,
+                        help='# times to repeat each --index-load-bench measurement (default: 3)')
+    parser.add_argument('--search-peak', action='store_const', const=True, default=False,
+                        help='Search for each config\'s peak-throughput thread count instead of running every '
+                             'count in --nthread-series; the series is the coarse first round, and later rounds '
+                             'probe between the best count and its neighbours.  Results are in search.tsv')
+    parser.add_argument('--search-rounds', metavar='int', type=int, default=6,
+                        help='Maximum # --search-peak rounds, including the first (default: 6)')
+    parser.add_argument('--search-step', metavar='int', type=int, default=1,
+                        help='Only try thread counts that are multiples of this (and of the config\'s threads '
+                             'per process) when refining (default: 1)')
+    parser.add_argument('--search-noise', metavar='float', type=float, default=0.03,
+                        help='Stop refining between two thread counts once their throughputs are within this '
+                             'fraction of each other (default: 0.03)')
     parser.add_argument('--reads-per-thread', metavar='int', type=int, default=0,
                         help='set # of reads to align per thread/process directly, overrides --multiply-reads setting')
+    parser.add_argument('--target-seconds', metavar='float', type=float, default=0,
+                        help='Instead of using --reads-per-thread, run a short probe of each config and thread '
+                             'count and choose the # reads per thread so the search takes about this many seconds.  '
+                             'Choices are recorded in calibration.tsv in each config\'s output directory and reused')
+    parser.add_argument('--probe-reads-per-thread', metavar='int', type=int, default=2000,
+                        help='# reads per thread for the first --target-seconds probe; probes that search for '
+                             'under %0.0f seconds are repeated with more reads' % PROBE_MIN_SECONDS)
 
     go(parser.parse_args())
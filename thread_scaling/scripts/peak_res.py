@@ -21,6 +21,34 @@ def gt(m1, m2):
     return convert(m1) > convert(m2)
 
 
+def peak_proc_csv(fn):
+    """ Peak resident set size from a procmon .proc.csv file, as the sum
+        and the max over the run's aligner processes of each one's VmHWM.
+        The sum counts pages shared between processes once per process, so
+        it overstates multiprocess runs with --mm, where every process maps
+        the same index; the max is a lower bound for those. """
+    peaks = {}
+    with open(fn) as fh:
+        cols = fh.readline().rstrip().split(',')
+        pid_i, hwm_i = cols.index('pid'), cols.index('vmhwm')
+        for ln in fh:
+            toks = ln.rstrip().split(',')
+            pid, hwm = toks[pid_i], int(toks[hwm_i])
+            peaks[pid] = max(peaks.get(pid, 0), hwm)
+    return sum(peaks.values()), max(peaks.values()) if peaks else 0
+
+
+for fn in glob.glob('*.proc.csv'):
+    # bt2-final-mp16_unp_16_0_48_1.proc.csv
+    fntoks = fn[:-len('.proc.csv')].split('_')
+    if fntoks[-1] != '1':
+        continue
+    nthreads = int(fntoks[-2])
+    # columns: # threads, summed peak RSS, largest single-process peak RSS
+    print('%d %0.3f %0.3f' % ((nthreads,) + peak_proc_csv(fn)))
+
+
+# runs from before procmon, or on systems without /proc, have top output
 for fn in glob.glob('*.top'):
     # bwa_unp_0_0_48_2.top
     fntoks = fn.split('_')
@@ -38,4 +66,4 @@ for fn in glob.glob('*.top'):
                 #print((mem, high_mem))
                 if gt(mem, high_mem):
                     high_mem = mem
-    print('%d %0.3f' % (nthreads, convert(high_mem)))
+    print('%d %0.3f %0.3f' % (nthreads, convert(high_mem), convert(high_mem)))
@@ -0,0 +1,282 @@
+"""
+procmon.py
+
+Samples resource usage of the aligner processes started by master.py,
+replacing the top and iostat processes it used to run in the background.
+
+A single thread reads /proc/<pid>/stat, /proc/<pid>/status and
+/proc/<pid>/io for just the aligner PIDs, plus /proc/diskstats, every
+interval seconds.  The /proc files are kept open and re-read from offset 0,
+so a sample costs a handful of small reads and no process creation.
+
+Writes two CSV time series per run:
+
+  <run>.proc.csv  time, pid, state, utime, stime (seconds), num_threads,
+                  rss, vmhwm (bytes; vmhwm is the peak RSS so far),
+                  minflt, majflt, read_bytes, write_bytes
+  <run>.disk.csv  time, device, rd_ios, rd_sectors, wr_ios, wr_sectors,
+                  io_ms (cumulative counters from /proc/diskstats)
+
+Times are seconds since the sampler started.  A process's last row, with
+state X, is its final usage as reported by wait4() when master.py reaps
+it: /proc can't give that, since a process's VmHWM goes away as soon as it
+exits and everything else once it's reaped, so a run shorter than the
+interval would otherwise have no rows at all.  In that row, rss and
+num_threads are 0, and read_bytes and write_bytes are block counts times
+512, which is also how the kernel counts them for /proc/<pid>/io.  The
+kernel folds the spawning process's peak RSS into wait4()'s maxrss, so the
+final vmhwm is maxrss only if that exceeds master.py's own VmHWM when the
+process was spawned, and otherwise the highest VmHWM sampled from /proc.
+
+With threads=True, also reads /proc/<pid>/task/<tid>/{stat,status} for
+every thread of every aligner process, and on close() writes a summary of
+each thread to <run>.threads.tsv: final utime and stime, voluntary and
+nonvoluntary context switches (voluntary switches mostly mean blocking,
+e.g. on a lock), the # samples at which the thread was on a different CPU
+than at the previous sample, and the # distinct CPUs it was seen on.
+"""
+
+from __future__ import print_function
+import os
+import time
+import threading
+
+
+PROC_COLS = ['time', 'pid', 'state', 'utime', 'stime', 'num_threads', 'rss', 'vmhwm',
+             'minflt', 'majflt', 'read_bytes', 'write_bytes']
+DISK_COLS = ['time', 'device', 'rd_ios', 'rd_sectors', 'wr_ios', 'wr_sectors', 'io_ms']
+THREAD_COLS = ['pid', 'tid', 'utime', 'stime', 'voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches',
+               'cpu_migrations', 'ncpus', 'last_cpu', 'nsamples']
+
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def available():
+    """ True iff this system has the /proc files we sample """
+    return os.path.exists('/proc/self/stat') and os.path.exists('/proc/diskstats')
+
+
+def pread_all(fd, size=8192):
+    """ Read a /proc file from the beginning through an open descriptor """
+    buf = os.pread(fd, size, 0)
+    while len(buf) == size:
+        size *= 2
+        buf = os.pread(fd, size, 0)
+    return buf
+
+
+def parse_stat(buf):
+    """ state, utime, stime, num_threads, rss, minflt, majflt from the
+        contents of /proc/<pid>/stat """
+    # fields after the command name, which is in parens and can contain
+    # spaces; fields[0] is field 3 (state) in proc(5)
+    fields = buf[buf.rindex(b')') + 2:].split()
+    return (fields[0].decode(), int(fields[11]) / float(CLK_TCK), int(fields[12]) / float(CLK_TCK),
+            int(fields[17]), int(fields[21]) * PAGE_SIZE, int(fields[7]), int(fields[9]))
+
+
+def parse_status_hwm(buf):
+    """ VmHWM, the peak resident set size, in bytes from /proc/<pid>/status """
+    i = buf.find(b'VmHWM:')
+    if i < 0:
+        return 0
+    return int(buf[i+6:buf.index(b'\n', i)].split()[0]) * 1024
+
+
+def parse_thread_stat(buf):
+    """ utime, stime (seconds) and the CPU last run on from
+        /proc/<pid>/task/<tid>/stat """
+    fields = buf[buf.rindex(b')') + 2:].split()
+    return int(fields[11]) / float(CLK_TCK), int(fields[12]) / float(CLK_TCK), int(fields[36])
+
+
+def parse_ctxt_switches(buf):
+    """ voluntary, nonvoluntary context switches from a status file """
+    i = buf.find(b'\nvoluntary_ctxt_switches:')
+    j = buf.find(b'\nnonvoluntary_ctxt_switches:')
+    return (int(buf[i+25:buf.index(b'\n', i+1)]) if i >= 0 else 0,
+            int(buf[j+28:buf.index(b'\n', j+1)]) if j >= 0 else 0)
+
+
+class ThreadSummary(object):
+    """ Running summary of one thread's samples """
+
+    def __init__(self, pid, tid):
+        self.pid, self.tid = pid, tid
+        self.fds = []
+        for name in ['stat', 'status']:
+            self.fds.append(os.open('/proc/%d/task/%d/%s' % (pid, tid, name), os.O_RDONLY))
+        self.utime, self.stime, self.vcs, self.nvcs = 0.0, 0.0, 0, 0
+        self.cpu, self.migrations, self.cpus, self.nsamples = None, 0, set(), 0
+
+    def sample(self):
+        """ Update from the thread's /proc files; False once it's gone """
+        if self.fds is None:
+            return False
+        try:
+            utime, stime, cpu = parse_thread_stat(pread_all(self.fds[0]))
+            vcs, nvcs = parse_ctxt_switches(pread_all(self.fds[1]))
+        except (OSError, ValueError):
+            self.close()
+            return False
+        self.utime, self.stime, self.vcs, self.nvcs = utime, stime, vcs, nvcs
+        if self.cpu is not None and cpu != self.cpu:
+            self.migrations += 1
+        self.cpu = cpu
+        self.cpus.add(cpu)
+        self.nsamples += 1
+        return True
+
+    def close(self):
+        if self.fds is not None:
+            for fd in self.fds:
+                os.close(fd)
+        self.fds = None
+
+    def row(self):
+        return [self.pid, self.tid, '%0.2f' % self.utime, '%0.2f' % self.stime, self.vcs, self.nvcs,
+                self.migrations, len(self.cpus), 'NA' if self.cpu is None else self.cpu, self.nsamples]
+
+
+def parse_io(buf):
+    """ read_bytes, write_bytes from /proc/<pid>/io """
+    rd, wr = 0, 0
+    for ln in buf.split(b'\n'):
+        if ln.startswith(b'read_bytes:'):
+            rd = int(ln.split()[1])
+        elif ln.startswith(b'write_bytes:'):
+            wr = int(ln.split()[1])
+    return rd, wr
+
+
+def parse_diskstats(buf):
+    """ (device, rd_ios, rd_sectors, wr_ios, wr_sectors, io_ms) for each
+        device, skipping loop and ram devices """
+    ret = []
+    for ln in buf.split(b'\n'):
+        toks = ln.split()
+        if len(toks) < 13:
+            continue
+        dev = toks[2].decode()
+        if dev.startswith('loop') or dev.startswith('ram'):
+            continue
+        ret.append((dev, int(toks[3]), int(toks[5]), int(toks[7]), int(toks[9]), int(toks[12])))
+    return ret
+
+
+class ProcSampler(object):
+    """ Samples the processes passed to add_pid(), and the disks, every
+        interval seconds on a background thread until close().  With
+        threads=True, also samples and summarizes each process's threads. """
+
+    def __init__(self, prefix, interval=0.5, threads=False):
+        self.interval = interval
+        self.prefix = prefix
+        self.thread_summaries = {} if threads else None  # (pid, tid) -> ThreadSummary
+        self.proc_fh = open(prefix + '.proc.csv', 'w')
+        self.disk_fh = open(prefix + '.disk.csv', 'w')
+        self.proc_fh.write(','.join(PROC_COLS) + '\n')
+        self.disk_fh.write(','.join(DISK_COLS) + '\n')
+        self.disk_fd = os.open('/proc/diskstats', os.O_RDONLY)
+        self.fds = {}  # pid -> [stat fd, status fd, io fd or None]
+        self.hwms = {}  # pid -> (our VmHWM when it was added, its highest sampled VmHWM)
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.t0 = time.monotonic()
+        self.nsamples = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_pid(self, pid):
+        fds = []
+        for name in ['stat', 'status', 'io']:
+            try:
+                fds.append(os.open('/proc/%d/%s' % (pid, name), os.O_RDONLY))
+            except OSError:
+                fds.append(None)  # already gone, or io not readable
+        with open('/proc/self/status', 'rb') as fh:
+            own_hwm = parse_status_hwm(fh.read())
+        with self.lock:
+            self.fds[pid] = fds
+            self.hwms[pid] = (own_hwm, 0)
+
+    def finish_pid(self, pid, rusage):
+        """ Record the final usage of a process just reaped by wait4(), and
+            stop sampling it """
+        tm = '%0.3f' % (time.monotonic() - self.t0)
+        with self.lock:
+            if pid in self.fds:
+                self._drop(pid)
+            own_hwm, hwm = self.hwms.pop(pid, (0, 0))
+            if rusage.ru_maxrss * 1024 > own_hwm:
+                hwm = rusage.ru_maxrss * 1024
+            self.proc_fh.write('%s,%d,X,%0.2f,%0.2f,0,0,%d,%d,%d,%d,%d\n' %
+                               (tm, pid, rusage.ru_utime, rusage.ru_stime, hwm,
+                                rusage.ru_minflt, rusage.ru_majflt, rusage.ru_inblock * 512,
+                                rusage.ru_oublock * 512))
+
+    def _drop(self, pid):
+        for fd in self.fds.pop(pid):
+            if fd is not None:
+                os.close(fd)
+
+    def sample(self):
+        tm = '%0.3f' % (time.monotonic() - self.t0)
+        with self.lock:
+            for pid in list(self.fds):
+                stat_fd, status_fd, io_fd = self.fds[pid]
+                try:
+                    state, utime, stime, nthreads, rss, minflt, majflt = parse_stat(pread_all(stat_fd))
+                    hwm = parse_status_hwm(pread_all(status_fd))
+                    rd, wr = parse_io(pread_all(io_fd)) if io_fd is not None else ('NA', 'NA')
+                except (OSError, TypeError):
+                    # process exited since the last sample; finish_pid()
+                    # records its final usage
+                    self._drop(pid)
+                    continue
+                self.hwms[pid] = (self.hwms[pid][0], max(self.hwms[pid][1], hwm))
+                if self.thread_summaries is not None:
+                    self.sample_threads(pid)
+                self.proc_fh.write('%s,%d,%s,%0.2f,%0.2f,%d,%d,%d,%d,%d,%s,%s\n' %
+                                   (tm, pid, state, utime, stime, nthreads, rss, hwm, minflt, majflt, rd, wr))
+        for dev in parse_diskstats(pread_all(self.disk_fd)):
+            self.disk_fh.write(tm + ',' + ','.join(map(str, dev)) + '\n')
+        self.nsamples += 1
+
+    def sample_threads(self, pid):
+        try:
+            tids = os.listdir('/proc/%d/task' % pid)
+        except OSError:
+            return
+        for tid in map(int, tids):
+            if (pid, tid) not in self.thread_summaries:
+                try:
+                    self.thread_summaries[(pid, tid)] = ThreadSummary(pid, tid)
+                except OSError:
+                    continue  # thread already exited
+            self.thread_summaries[(pid, tid)].sample()
+
+    def _run(self):
+        while not self.done.wait(self.interval):
+            self.sample()
+
+    def close(self):
+        """ Take one last sample, then stop """
+        self.done.set()
+        self.thread.join()
+        self.sample()
+        with self.lock:
+            for pid in list(self.fds):
+                self._drop(pid)
+        os.close(self.disk_fd)
+        self.proc_fh.close()
+        self.disk_fh.close()
+        if self.thread_summaries is not None:
+            with open(self.prefix + '.threads.tsv', 'w') as fh:
+                fh.write('\t'.join(THREAD_COLS) + '\n')
+                for key in sorted(self.thread_summaries):
+                    summ = self.thread_summaries[key]
+                    summ.close()
+                    fh.write('\t'.join(map(str, summ.row())) + '\n')
@@ -6,6 +6,10 @@ Constructs reads files for thread-scaling experiments.
   bowtie2 and hisat
 - Can trim reads as it goes, so can produce either reads the same length as
   input, or shorter for tools like bowtie
+- Can pack blocked output with a variable # reads per block (--pack-blocks),
+  recorded in the .fqi sidecar index
+- Can sample the accessions in parallel (--jobs) with output identical to a
+  serial run, since each accession has its own sampler seed
 
 To construct inputs for our experiments:
 - pypy reads.py --prefix=mix100 --reads-per-accession=100000000
@@ -15,33 +19,54 @@ To construct inputs for our experiments:
 from __future__ import print_function
 import sys
 import random
-import gzip
+import math
 import os
 import numpy as np
-import subprocess
 import shutil
+import multiprocessing
+import json
+import zlib
+import fastq
 
 
 class ReservoirSampler(object):
-    """ Simple reservoir sampler """
+    """ Reservoir sampler using Li's Algorithm L: once the reservoir is full,
+        draws how many elements to skip before the next one that replaces a
+        reservoir element, instead of drawing a random number per element.
+        Records go to a text file, one line per accepted record, so a record
+        that is later evicted from the reservoir still has a line. """
 
-    def __init__(self, k, fn):
+    needs_records = True
+
+    def __init__(self, k, fn, seed=None):
         self.k = k  # # elts to collect
         self.n = 0  # # elts scanned
         self.fn = fn
         self.ofh = open(fn, 'wb')
-
-    def add_pre(self):
+        self.rng = random.Random(seed)
+        self.w = None
+
+    def _uniform(self):
+        """ Uniform draw from the open interval (0, 1) """
+        while True:
+            u = self.rng.random()
+            if u > 0.0:
+                return u
+
+    def next_sample(self):
+        """ Return (# elts to skip, reservoir slot for the elt after them) """
         if self.n < self.k:
             self.n += 1
-            return self.n - 1
-        else:
-            self.n += 1
-            j = random.randint(0, self.n)
-            return j if j < self.k else None
+            return 0, self.n - 1
+        if self.w is None:
+            self.w = math.exp(math.log(self._uniform()) / self.k)
+        nskip = int(math.floor(math.log(self._uniform()) / math.log(1.0 - self.w)))
+        self.w *= math.exp(math.log(self._uniform()) / self.k)
+        self.n += nskip + 1
+        return nskip, self.rng.randrange(self.k)
 
-    def add_post(self, obj, j):
-        self.ofh.write('\t'.join([str(j)] + list(map(str, obj))) + '\n')
+    def add_post(self, obj, j, ordinal):
+        self.ofh.write(b'\t'.join([str(j).encode()] + list(obj)) + b'\n')
 
     def close(self):
         if self.ofh is not None:
@@ -49,6 +74,38 @@ class ReservoirSampler(object):
         self.ofh = None
 
 
+class OrdinalReservoirSampler(ReservoirSampler):
+    """ Like ReservoirSampler, but keeps only the ordinal of the record in
+        each reservoir slot, in an array that is saved to fn (.npy) at close.
+        The surviving records are fetched afterwards by fetch_reservoir(). """
+
+    needs_records = False
+
+    def __init__(self, k, fn, seed=None):
+        self.k = k  # # elts to collect
+        self.n = 0  # # elts scanned
+        self.fn = fn
+        self.ords = np.zeros(k, dtype=np.uint32)
+        self.rng = random.Random(seed)
+        self.w = None
+
+    def add_post(self, obj, j, ordinal):
+        if ordinal > 0xffffffff and self.ords.dtype == np.uint32:
+            self.ords = self.ords.astype(np.uint64)
+        self.ords[j] = ordinal
+
+    def close(self):
+        if self.ords is not None:
+            if self.n < self.k:
+                self.ords = self.ords[:self.n]
+            np.save(self.fn, self.ords)
+        self.ords = None
+
+
+reservoir_modes = {'text': ('.reads.py.tmp%d', ReservoirSampler),
+                   'array': ('.reads.py.res%d.npy', OrdinalReservoirSampler)}
+
+
 def mkdir_quiet(dr):
     """ Create directories needed to ensure 'dr' exists; no complaining """
     import errno
@@ -60,10 +117,6 @@ def mkdir_quiet(dr):
                 raise
 
 
-def wcl(fn):
-    return int(subprocess.check_output('wc -l ' + fn, shell=True).strip().split()[0])
-
-
 reads = [
     # https://www.ncbi.nlm.nih.gov/sra/?term=ERR194147
     # Platinum genomes project, Illumina Cambridge
@@ -97,7 +150,7 @@ def reverse_readline(filename, buf_size=8192):
             fh.seek(file_size - offset)
             buffer = fh.read(min(remaining_size, buf_size))
             remaining_size -= buf_size
-            lines = buffer.split('\n')
+            lines = buffer.split(b'\n')
             # the first line of the buffer is probably not a complete line so
             # we'll save it and append it to the last line of the next buffer
             # we read
@@ -105,7 +158,7 @@ def reverse_readline(filename, buf_size=8192):
                 # if the previous chunk starts right from the beginning of line
                 # do not concact the segment to the last line of new chunk
                 # instead, yield the segment first
-                if buffer[-1] is not '\n':
+                if buffer[-1:] != b'\n':
                     lines[-1] += segment
                 else:
                     yield segment
@@ -118,9 +171,456 @@ def reverse_readline(filename, buf_size=8192):
             yield segment
 
 
+class FeistelPermutation(object):
+    """ Seeded pseudo-random permutation of [0, n) that computes the image of
+        any index on demand, in constant memory: a balanced Feistel network
+        over the smallest even number of bits covering n, plus cycle walking
+        to map images that land outside [0, n) back inside """
+
+    def __init__(self, n, seed, rounds=6):
+        self.n = n
+        bits = max(2, int(n - 1).bit_length())
+        bits += bits % 2
+        self.half = np.uint64(bits // 2)
+        self.mask = np.uint64((1 << (bits // 2)) - 1)
+        rng = random.Random(seed)
+        self.keys = [np.uint64(rng.getrandbits(64)) for _ in range(rounds)]
+
+    def _round(self, r, key):
+        """ Round function: splitmix64-style hash of r keyed with key """
+        x = (r ^ key) * np.uint64(0x9E3779B97F4A7C15)
+        x ^= x >> np.uint64(31)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(29)
+        return x & self.mask
+
+    def _encrypt(self, x):
+        left, right = x >> self.half, x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self.half) | right
+
+    def __call__(self, idx):
+        """ Image of each element of the array idx, which are in [0, n) """
+        out = self._encrypt(np.asarray(idx, dtype=np.uint64))
+        walk = np.flatnonzero(out >= self.n)
+        while len(walk) > 0:
+            out[walk] = self._encrypt(out[walk])
+            walk = walk[out[walk] >= self.n]
+        return out.astype(np.int64)
+
+
+# write buffer per bucket file while scattering: an equal share of the
+# memory budget, within these bounds
+SCATTER_BUFFER_MIN = 8 * 1024
+SCATTER_BUFFER_MAX = 1024 * 1024
+
+# file descriptors to leave for everything other than the bucket files
+FD_RESERVE = 32
+
+
+def ensure_open_files(n):
+    """ Make sure n files can be open at once, on top of FD_RESERVE others,
+        raising the soft RLIMIT_NOFILE as far as the hard limit if need be """
+    try:
+        import resource
+    except ImportError:
+        return  # no rlimits here; open() will complain if it has to
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    need = n + FD_RESERVE
+    if soft == resource.RLIM_INFINITY or soft >= need:
+        return
+    if hard != resource.RLIM_INFINITY and hard < need:
+        raise RuntimeError('%d buckets need %d open files, but the limit is %d; raise --sort-gb, lower '
+                           '--jobs or raise the hard limit on open files (ulimit -Hn)' % (n, need, hard))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (need, hard))
+
+
+class BucketScatter(object):
+    """ First pass of the shuffle: appends each record line to the bucket file
+        covering its permuted rank, so that buckets can then be put in order
+        one at a time by gather_bucket() without a comparison sort.  Every
+        bucket is open at once, so their write buffers together are kept
+        within max_buffer_bytes. """
+
+    def __init__(self, dr, nreads, bucket_size, max_buffer_bytes):
+        self.bucket_size = bucket_size
+        self.nbuckets = (nreads + bucket_size - 1) // bucket_size
+        self.buffering = min(SCATTER_BUFFER_MAX, max(SCATTER_BUFFER_MIN, max_buffer_bytes // self.nbuckets))
+        self.fns = [os.path.join(dr, '.reads.py.bucket%05d' % i) for i in range(self.nbuckets)]
+        self.ofhs = [open(fn, 'wb', self.buffering) for fn in self.fns]
+        self.n = 0
+        self.crcs = [0] * self.nbuckets
+
+    def write(self, rank, rec):
+        b = rank // self.bucket_size
+        ln = str(rank).encode() + b'\t' + rec + b'\n'
+        self.ofhs[b].write(ln)
+        self.crcs[b] = zlib.crc32(ln, self.crcs[b]) & 0xffffffff
+        self.n += 1
+
+    def close(self):
+        for ofh in self.ofhs:
+            ofh.close()
+        self.ofhs = []
+
+
+# memory overhead of holding a line as a bytes object in a list, on 64-bit
+# CPython: the bytes object header, plus the list's pointer to it
+BYTES_OVERHEAD = 33
+LIST_SLOT_BYTES = 8
+
+
+def bucket_size_for(sort_gb, jobs, max_read_size):
+    """ # ranks per bucket such that 'jobs' buckets loaded at once fit in
+        sort_gb GB, assuming a line holds two reads of up to max_read_size
+        bytes plus ~32 bytes of rank and separators, and is held as a bytes
+        object in a list """
+    bytes_per_rec = 2 * max_read_size + 32 + BYTES_OVERHEAD + LIST_SLOT_BYTES
+    return max(1, (sort_gb * 1024 * 1024 * 1024) // (jobs * bytes_per_rec))
+
+
+def gather_bucket(job):
+    """ Second pass of the shuffle: loads one bucket, puts each line at the
+        position given by its rank, and writes the lines out in rank order """
+    bucket_fn, ofn, base, size = job
+    lines = [None] * size
+    with open(bucket_fn, 'rb') as fh:
+        for ln in fh:
+            rank = int(ln[:ln.find(b'\t')])
+            assert base <= rank < base + size
+            assert lines[rank - base] is None, 'rank %d seen twice' % rank
+            lines[rank - base] = ln
+    if any(ln is None for ln in lines):
+        raise RuntimeError('Bucket "%s" is missing %d ranks' % (bucket_fn, lines.count(None)))
+    # write the lines as they are rather than joining them, which would
+    # briefly need twice the memory
+    crc = 0
+    for ln in lines:
+        crc = zlib.crc32(ln, crc)
+    with open(ofn, 'wb') as ofh:
+        ofh.writelines(lines)
+    return crc & 0xffffffff
+
+
+def sorted_lines(fns, skip=0):
+    """ Generator over the lines of the sorted bucket files, in order,
+        after the first skip lines """
+    for fn in fns:
+        with open(fn, 'rb') as fh:
+            for ln in fh:
+                if skip > 0:
+                    skip -= 1
+                    continue
+                yield ln
+
+
+class OutputWriter(object):
+    """ Writes the unblocked (_1.fq/_2.fq) and blocked (_block_1.fq/
+        _block_2.fq) outputs in a single pass over the sorted records.  A
+        blocked block is the same bytes as the corresponding reads_per_block
+        unblocked records, except that the name line of its last record is
+        padded with spaces so the block is exactly block_sz bytes.  Also
+        writes a sidecar index (fastq.IndexWriter) for each output.
+
+        With pack=True, a block instead holds as many records as fit in
+        block_sz bytes for both mates, so the # reads per block varies and
+        is recorded only in the index. """
+
+    def __init__(self, prefix, block_sz, reads_per_block, flush_bytes=16 * 1024 * 1024,
+                 resume=None, on_checkpoint=None, pack=False):
+        self.block_sz = block_sz
+        self.reads_per_block = reads_per_block
+        self.pack = pack
+        self.flush_bytes = flush_bytes
+        self.on_checkpoint = on_checkpoint
+        self.fns = self.output_fns(prefix)
+        if resume is None:
+            self.ofhs = [open(fn, 'wb') for fn in self.fns]
+            self.crcs = [0, 0, 0, 0]
+            self.nreads = 0
+        else:
+            # pick up from a checkpoint: drop anything written after it
+            self.ofhs = [open(fn, 'r+b') for fn in self.fns]
+            for ofh, size in zip(self.ofhs, resume['sizes']):
+                ofh.truncate(size)
+                ofh.seek(size)
+            self.crcs = list(resume['crcs'])
+            self.nreads = resume['nreads']
+        self.idxs = [fastq.IndexWriter(fastq.index_fn(fn), block_bytes=block_sz if i >= 2 else 0,
+                                       reads_per_block=0 if pack else reads_per_block,
+                                       resume=None if resume is None else resume['indexes'][i])
+                     for i, fn in enumerate(self.fns)]
+        self.bufs = [[], [], [], []]  # pending pieces for each output
+        self.nbuf = 0  # # bytes of memory held by bufs, counting object overhead
+        self.blk1, self.blk2 = [], []  # records in the current block
+        self.nblk1, self.nblk2 = 0, 0  # bytes in the current block
+
+    @staticmethod
+    def output_fns(prefix):
+        return [prefix + suf for suf in ['_1.fq', '_2.fq', '_block_1.fq', '_block_2.fq']]
+
+    def add(self, ln):
+        """ Add a sorted line: rank, then the 4 lines of each mate, tab-separated """
+        toks = ln.rstrip().split(b'\t')
+        assert toks[1][:1] == b'@'
+        assert toks[3][:1] == b'+'
+        assert toks[5][:1] == b'@'
+        assert toks[7][:1] == b'+'
+        rec1 = b'\n'.join(toks[1:5]) + b'\n'
+        rec2 = b'\n'.join(toks[5:9]) + b'\n'
+        if self.pack and len(self.blk1) > 0 and \
+                (self.nblk1 + len(rec1) > self.block_sz or self.nblk2 + len(rec2) > self.block_sz):
+            # this pair would overflow the current block for one of the mates
+            self._end_block()
+        self.blk1.append(rec1)
+        self.blk2.append(rec2)
+        self.nreads += 1
+        self.nblk1 += len(rec1)
+        self.nblk2 += len(rec2)
+        if not self.pack and len(self.blk1) == self.reads_per_block:
+            self._end_block()
+
+    def _pad_block(self, blk, nbytes, idx):
+        """ Pieces making up a blocked copy of blk: the records, with padding
+            after the name of the last one """
+        if nbytes > self.block_sz:
+            raise RuntimeError('%d reads take %d bytes, more than the block size (%d); '
+                               'increase --max-read-size' % (len(blk), nbytes, self.block_sz))
+        pad = self.block_sz - nbytes
+        idx.add_block(list(map(len, blk)), pad)
+        last = blk[-1]
+        name_end = last.index(b'\n')
+        return blk[:-1] + [last[:name_end], b' ' * pad, last[name_end:]]
+
+    def _end_block(self):
+        self.bufs[0].extend(self.blk1)
+        self.bufs[1].extend(self.blk2)
+        self.idxs[0].add_block(list(map(len, self.blk1)))
+        self.idxs[1].add_block(list(map(len, self.blk2)))
+        self.bufs[2].extend(self._pad_block(self.blk1, self.nblk1, self.idxs[2]))
+        self.bufs[3].extend(self._pad_block(self.blk2, self.nblk2, self.idxs[3]))
+        # the blocked copies share the records' bytes objects with the
+        # unblocked ones, apart from each mate's last record, which is split
+        # into 3 new pieces around the padding
+        nrec = len(self.blk1)
+        self.nbuf += 2 * self.block_sz + len(self.blk1[-1]) + len(self.blk2[-1])
+        self.nbuf += (2 * nrec + 6) * BYTES_OVERHEAD + (4 * nrec + 4) * LIST_SLOT_BYTES
+        self.blk1, self.blk2 = [], []
+        self.nblk1, self.nblk2 = 0, 0
+        if self.nbuf >= self.flush_bytes:
+            self.flush()
+            if self.on_checkpoint is not None:
+                self.on_checkpoint(self.state())
+
+    def flush(self):
+        for i, (ofh, buf) in enumerate(zip(self.ofhs, self.bufs)):
+            crc = self.crcs[i]
+            for piece in buf:
+                crc = zlib.crc32(piece, crc)
+            self.crcs[i] = crc & 0xffffffff
+            ofh.writelines(buf)
+        self.bufs = [[], [], [], []]
+        self.nbuf = 0
+
+    def state(self):
+        """ Checkpoint of a flushed writer, at a block boundary, from which a
+            new writer can resume (resume=state) """
+        assert len(self.blk1) == 0 and self.nbuf == 0
+        for ofh in self.ofhs:
+            ofh.flush()
+        return {'nreads': self.nreads, 'sizes': [ofh.tell() for ofh in self.ofhs],
+                'crcs': self.crcs, 'indexes': [idx.state() for idx in self.idxs]}
+
+    def nblocks(self):
+        return self.idxs[2].nblocks
+
+    def close(self):
+        if self.pack and len(self.blk1) > 0:
+            self._end_block()
+        if len(self.blk1) > 0:
+            # unblocked outputs get the partial block before giving up
+            self.bufs[0].extend(self.blk1)
+            self.bufs[1].extend(self.blk2)
+            self.idxs[0].add_block(list(map(len, self.blk1)))
+            self.idxs[1].add_block(list(map(len, self.blk2)))
+        self.flush()
+        for ofh in self.ofhs:
+            ofh.close()
+        for idx in self.idxs:
+            idx.close()
+        if len(self.blk1) > 0:
+            raise RuntimeError('Did not end on block boundary')
+
+
+def file_crc32(fn, chunk_size=4 * 1024 * 1024):
+    crc = 0
+    with open(fn, 'rb') as fh:
+        while True:
+            buf = fh.read(chunk_size)
+            if len(buf) == 0:
+                return crc
+            crc = zlib.crc32(buf, crc) & 0xffffffff
+
+
+class Manifest(object):
+    """ On-disk record, in --temp-dir, of which phases of a run have
+        finished and the sizes and CRC-32s of the files they left behind.
+        Lets --resume skip finished accessions, the permute step, finished
+        buckets of the sort step and already-written output. """
+
+    def __init__(self, fn, params):
+        self.fn = fn
+        self.phases = {}
+        if os.path.exists(fn):
+            with open(fn) as fh:
+                saved = json.load(fh)
+            if saved['params'] != params:
+                raise RuntimeError('Cannot resume: parameters differ from those of the interrupted run '
+                                   '(%s vs %s)' % (str(params), str(saved['params'])))
+            self.phases = saved['phases']
+        self.params = params
+
+    def save(self):
+        with open(self.fn + '.tmp', 'w') as fh:
+            json.dump({'params': self.params, 'phases': self.phases}, fh)
+        os.rename(self.fn + '.tmp', self.fn)
+
+    def finish(self, phase, fns=(), file_crcs=None, **info):
+        """ Record that phase is done and left behind files fns """
+        if file_crcs is None:
+            file_crcs = [file_crc32(fn) for fn in fns]
+        info['files'] = [[fn, os.path.getsize(fn), crc] for fn, crc in zip(fns, file_crcs)]
+        self.phases[phase] = info
+        self.save()
+
+    def done(self, phase, verify_crc=False):
+        """ Info recorded for phase if it is done and its files are intact;
+            otherwise None """
+        info = self.phases.get(phase)
+        if info is None:
+            return None
+        for fn, size, crc in info['files']:
+            if not os.path.exists(fn) or os.path.getsize(fn) != size or \
+                    (verify_crc and crc is not None and file_crc32(fn) != crc):
+                print('Redoing phase "%s" because "%s" is missing or changed' % (phase, fn), file=sys.stderr)
+                del self.phases[phase]
+                return None
+        return info
+
+
+def accession_seed(seed, si):
+    """ Seed for the reservoir sampler of the si-th accession; independent of
+        which process (or in what order) the accession is sampled """
+    return seed * len(reads) + si
+
+
+def read_pair(r1, r2, trim_to):
+    """ Parse the next record from each mate file, trimming sequence and
+        qualities to trim_to; returns None at end of input """
+    l1 = r1.readline().rstrip()
+    l2 = r2.readline().rstrip()
+    if len(l1) == 0:
+        return None
+    seq1 = r1.readline().rstrip()
+    seq2 = r2.readline().rstrip()
+    assert len(seq1) > 0
+    assert len(seq1) == len(seq2)
+    r1.readline()
+    r2.readline()
+    qual1 = r1.readline().rstrip()
+    qual2 = r2.readline().rstrip()
+    assert len(qual1) > 0
+    assert len(qual1) == len(seq1)
+    assert len(qual1) == len(qual2)
+    if len(seq1) > trim_to:
+        seq1 = seq1[:trim_to]
+        qual1 = qual1[:trim_to]
+    if len(seq2) > trim_to:
+        seq2 = seq2[:trim_to]
+        qual2 = qual2[:trim_to]
+    return [l1, seq1, b'+', qual1, l2, seq2, b'+', qual2]
+
+
+def sample_accession(job):
+    """ Reservoir-sample reads from one accession's pair of FASTQ files into
+        its own temporary file.  Shares no state with other accessions, so can
+        run in a worker process. """
+    si, reads_per_accession, tmpfn, args = job
+    rd = reads[si]
+    sampler_class = reservoir_modes[args.reservoir][1]
+    samp = sampler_class(reads_per_accession, tmpfn, seed=accession_seed(args.seed, si))
+    print('Handling ' + rd['srr'], file=sys.stderr)
+    ival_mult = 1.2
+    n = 0
+    ival = 100
+    last_seqlen = None
+    with fastq.FastqReader(os.path.basename(rd['url1']), decompress=args.decompress) as r1:
+        with fastq.FastqReader(os.path.basename(rd['url2']), decompress=args.decompress) as r2:
+            while True:
+                nskip, j = samp.next_sample()
+                if args.stop_after is not None:
+                    nskip = min(nskip, args.stop_after - n)
+                if nskip > 0:
+                    nskipped = r1.skip_records(nskip)
+                    r2.skip_records(nskip)
+                    n += nskipped
+                    if nskipped < nskip:
+                        break
+                if args.stop_after is not None and n >= args.stop_after:
+                    break
+                if samp.needs_records:
+                    rec = read_pair(r1, r2, args.trim_to)
+                    if rec is None:
+                        break
+                    assert last_seqlen is None or len(rec[1]) == last_seqlen
+                    last_seqlen = len(rec[1])
+                else:
+                    # records are fetched later, so just confirm it's there
+                    rec = None
+                    if r1.skip_records(1) == 0:
+                        break
+                    r2.skip_records(1)
+                samp.add_post(rec, j, n)
+                n += 1
+                if n >= ival:
+                    ival = int(ival * ival_mult)
+                    print('  %s: processed %d reads' % (rd['srr'], n), file=sys.stderr)
+                if args.stop_after is not None and n >= args.stop_after:
+                    break
+    samp.close()
+    return si
+
+
+def fetch_reservoir(si, res_fn, args, slot_ranks, emit, chunk=1 << 20):
+    """ Second pass over an accession's FASTQ files that parses just the
+        records whose ordinals survived in its reservoir array.  Calls
+        emit(rank, record) for each, where slot_ranks maps an array of
+        reservoir slots to ranks in the final shuffled order. """
+    rd = reads[si]
+    ords = np.load(res_fn)
+    slots = np.argsort(ords, kind='stable')
+    ords = ords[slots]
+    last_seqlen = None
+    cur = 0
+    with fastq.FastqReader(os.path.basename(rd['url1']), decompress=args.decompress) as r1:
+        with fastq.FastqReader(os.path.basename(rd['url2']), decompress=args.decompress) as r2:
+            for c in range(0, len(slots), chunk):
+                ranks = slot_ranks(slots[c:c+chunk]).tolist()
+                for rank, ordinal in zip(ranks, ords[c:c+chunk].tolist()):
+                    nskip = ordinal - cur
+                    if r1.skip_records(nskip) != nskip or r2.skip_records(nskip) != nskip:
+                        raise RuntimeError('%s ended before record %d' % (rd['srr'], ordinal))
+                    rec = read_pair(r1, r2, args.trim_to)
+                    if rec is None:
+                        raise RuntimeError('%s ended before record %d' % (rd['srr'], ordinal))
+                    assert last_seqlen is None or len(rec[1]) == last_seqlen
+                    last_seqlen = len(rec[1])
+                    emit(rank, rec)
+                    cur = ordinal + 1
+
+
 def go(args):
-    random.seed(args.seed)
-    np.random.seed(args.seed)
     if not args.resume and os.path.exists(args.temp_dir):
         raise RuntimeError('--temp-dir %s already exists' % args.temp_dir)
     mkdir_quiet(args.temp_dir)
@@ -129,178 +629,197 @@ def go(args):
 
     reads_per_accession = args.reads_per_accession - (args.reads_per_accession % reads_per_block)
     assert reads_per_accession % reads_per_block == 0
-    tmpfns = [os.path.join(args.temp_dir, '.reads.py.tmp%d') % i for i in range(len(reads))]
-    samplers = [ReservoirSampler(reads_per_accession, tmpfns[i]) for i in range(len(reads))]
-    unsrt_fn = os.path.join(args.temp_dir, '.reads.py.unsorted')
-    nreads = reads_per_accession * len(samplers)
+    tmp_pattern = reservoir_modes[args.reservoir][0]
+    tmpfns = [os.path.join(args.temp_dir, tmp_pattern) % i for i in range(len(reads))]
+    nreads = reads_per_accession * len(reads)
+    bucket_dir = os.path.join(args.temp_dir, 'buckets')
+
+    params = {k: getattr(args, k) for k in ['reads_per_accession', 'stop_after', 'max_read_size', 'block_boundary',
+                                            'seed', 'reservoir', 'trim_to', 'prefix', 'pack_blocks']}
+    manifest = Manifest(os.path.join(args.temp_dir, '.reads.py.manifest'), params)
+
+    # The bucket layout is fixed by the run that did the permute step
+    permuted = manifest.done('permute', verify_crc=args.verify_resume)
+    if permuted is not None:
+        bucket_size = permuted['bucket_size']
+    else:
+        bucket_size = bucket_size_for(args.sort_gb, args.jobs, args.max_read_size)
+    nbuckets = (nreads + bucket_size - 1) // bucket_size
+    bucket_fns = [os.path.join(bucket_dir, '.reads.py.bucket%05d' % i) for i in range(nbuckets)]
+    srt_fns = [fn + '.sorted' for fn in bucket_fns]
+    sorted_done = [manifest.done('sort:%d' % i, verify_crc=args.verify_resume) is not None
+                   for i in range(nbuckets)]
+    # a finished output phase lists its files, which done() checks; a
+    # checkpoint only has their sizes so far
+    if permuted is None and not all(sorted_done):
+        # check now, not after hours of sampling, that the scatter can
+        # have every bucket open at once
+        ensure_open_files(nbuckets)
+    output_state = manifest.done('output', verify_crc=args.verify_resume)
+    if output_state is not None and not output_state.get('complete') and 'sizes' in output_state:
+        out_fns = OutputWriter.output_fns(args.prefix)
+        if any(not os.path.exists(fn) or os.path.getsize(fn) < size
+               for fn, size in zip(out_fns, output_state['sizes'])):
+            print('Redoing output because some output files are missing or truncated', file=sys.stderr)
+            output_state = None
 
     ival_mult = 1.2
-    if (os.path.exists(unsrt_fn) and args.resume) or not os.path.exists(unsrt_fn):
-        n = 0
-        ival = 100
-        last_seqlen = None
+    if permuted is None and not all(sorted_done):
         print('*** Initial sampling run ***', file=sys.stderr)
-        for rd, samp in zip(reads, samplers):
-            print('Handling ' + rd['srr'], file=sys.stderr)
+        for rd in reads:
             for ur in ['url1', 'url2']:
                 if not os.path.exists(os.path.basename(rd[ur])):
                     raise RuntimeError('No file for %s' % rd[ur])
-            nfile = 0
-            with gzip.open(os.path.basename(rd['url1']), 'rb') as r1:
-                with gzip.open(os.path.basename(rd['url2']), 'rb') as r2:
-                    while True:
-                        j = samp.add_pre()
-                        if j is not None:
-                            l1 = r1.readline().rstrip()
-                            l2 = r2.readline().rstrip()
-                            if len(l1) == 0:
-                                break
-                            seq1 = r1.readline().rstrip()
-                            seq2 = r2.readline().rstrip()
-                            assert last_seqlen is None or len(seq1) == last_seqlen
-                            last_seqlen = len(seq1)
-                            assert len(seq1) > 0
-                            assert len(seq1) == len(seq2)
-                            r1.readline()
-                            r2.readline()
-                            qual1 = r1.readline().rstrip()
-                            qual2 = r2.readline().rstrip()
-                            assert len(qual1) > 0
-                            assert len(qual1) == len(seq1)
-                            assert len(qual1) == len(qual2)
-                            if len(seq1) > args.trim_to:
-                                seq1 = seq1[:args.trim_to]
-                                qual1 = qual1[:args.trim_to]
-                            if len(seq2) > args.trim_to:
-                                seq2 = seq2[:args.trim_to]
-                                qual2 = qual2[:args.trim_to]
-                            samp.add_post([l1, seq1, '+', qual1, l2, seq2, '+', qual2], j)
-                        else:
-                            # skip
-                            if len(r1.readline()) == 0:
-                                break
-                            r2.readline()
-                            for r in [r1, r2]:
-                                for _ in range(3):
-                                    r.readline()
-                        if n == ival:
-                            ival = int(ival * ival_mult)
-                            print('  processed %d reads' % n, file=sys.stderr)
-                        n += 1
-                        nfile += 1
-                        if args.stop_after is not None and nfile >= args.stop_after:
-                            break
-            samp.close()
+        jobs = [(si, reads_per_accession, tmpfns[si], args) for si in range(len(reads))
+                if manifest.done('sample:' + reads[si]['srr'], verify_crc=args.verify_resume) is None]
+        for si in range(len(reads)):
+            if all(job[0] != si for job in jobs):
+                print('Skipping %s; already sampled' % reads[si]['srr'], file=sys.stderr)
+
+        def _finish_sample(si):
+            manifest.finish('sample:' + reads[si]['srr'], [tmpfns[si]])
+
+        if args.jobs > 1 and len(jobs) > 1:
+            print('Sampling %d accessions with %d worker processes' %
+                  (len(jobs), min(args.jobs, len(jobs))), file=sys.stderr)
+            pool = multiprocessing.Pool(min(args.jobs, len(jobs)))
+            try:
+                for si in pool.imap_unordered(sample_accession, jobs, chunksize=1):
+                    _finish_sample(si)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in jobs:
+                _finish_sample(sample_accession(job))
 
         print('*** Permuting ***', file=sys.stderr)
-        print('Generating permutation with %d elements' % nreads, file=sys.stderr)
-        idxs = np.random.permutation(nreads)
+        print('Permuting %d elements' % nreads, file=sys.stderr)
+        perm = FeistelPermutation(nreads, args.seed)
         n = 0
         ival = 100
-        with open(unsrt_fn, 'wb') as ofh:
-            for si, sampler in enumerate(samplers):
+        mkdir_quiet(bucket_dir)
+        scatter = BucketScatter(bucket_dir, nreads, bucket_size, args.sort_gb * 1024 * 1024 * 1024)
+        print('Scattering records into %d buckets of %d, with %d bytes of buffer each' %
+              (nbuckets, bucket_size, scatter.buffering), file=sys.stderr)
+        try:
+            for si, tmpfn in enumerate(tmpfns):
+                offset = si * reads_per_accession
+
+                def _slot_ranks(slots):
+                    return perm(np.asarray(slots, dtype=np.int64) + offset)
+
+                if args.reservoir == 'array':
+                    def _emit(rank, rec):
+                        scatter.write(rank, b'\t'.join(rec))
+                    print('Fetching reservoir records for ' + reads[si]['srr'], file=sys.stderr)
+                    fetch_reservoir(si, tmpfn, args, _slot_ranks, _emit)
+                    continue
                 seen_items = set()
-                for ln in reverse_readline(sampler.fn):
+                pending_slots, pending_recs = [], []
+                for ln in reverse_readline(tmpfn):
                     ln = ln.rstrip()
-                    taboff = ln.find('\t')
+                    taboff = ln.find(b'\t')
                     assert taboff >= 0
                     orig_rank = int(ln[:taboff])
                     if orig_rank not in seen_items:
-                        i = orig_rank + si * reads_per_accession
-                        ofh.write(str(idxs[i]) + '\t' + ln[taboff+1:] + '\n')
+                        pending_slots.append(orig_rank)
+                        pending_recs.append(ln[taboff+1:])
                         seen_items.add(orig_rank)
+                        if len(pending_slots) >= 1 << 16:
+                            for rank, rec in zip(_slot_ranks(pending_slots).tolist(), pending_recs):
+                                scatter.write(rank, rec)
+                            pending_slots, pending_recs = [], []
                     if n == ival:
                         ival = int(ival * ival_mult)
                         print('  processed %d unsorted records' % n, file=sys.stderr)
                     n += 1
+                if len(pending_slots) > 0:
+                    for rank, rec in zip(_slot_ranks(pending_slots).tolist(), pending_recs):
+                        scatter.write(rank, rec)
                 del seen_items
-        del idxs
+        finally:
+            scatter.close()
+        if scatter.n != nreads:
+            raise RuntimeError('Number of reads scattered to buckets (%d) '
+                               'does not match target (%d)' % (scatter.n, nreads))
+        manifest.finish('permute', bucket_fns, file_crcs=scatter.crcs, bucket_size=bucket_size)
 
         if not args.keep_intermediates:
-            print('Deleting %d reservoir samplers:' % len(samplers), file=sys.stderr)
-            for samp in samplers:
-                del samp
+            print('Deleting %d reservoir temporary files:' % len(tmpfns), file=sys.stderr)
+            for fn in tmpfns:
+                os.remove(fn)
+    else:
+        print('Skipping sampling and permuting; already done', file=sys.stderr)
 
-    unsrt_n = wcl(unsrt_fn)
-    if unsrt_n != nreads:
-        raise RuntimeError('Number of reads in unsorted file "%s" (%d) '
-                           'does not match target (%d)' % (unsrt_fn, unsrt_n, nreads))
+    print('*** Sorting ***', file=sys.stderr)
+    gather_jobs = [(bucket_fns[i], srt_fns[i], i * bucket_size, min(bucket_size, nreads - i * bucket_size))
+                   for i in range(nbuckets) if not sorted_done[i]]
+    print('Putting %d of %d buckets in rank order with %d processes' %
+          (len(gather_jobs), nbuckets, args.jobs), file=sys.stderr)
 
-    if not args.keep_intermediates:
-        print('Deleting %d reservoir temporary files:' % len(samplers), file=sys.stderr)
-        for fn in tmpfns:
-            os.remove(fn)
+    def _finish_sort(job, crc):
+        manifest.finish('sort:%d' % bucket_fns.index(job[0]), [job[1]], file_crcs=[crc])
 
-    print('*** Sorting ***', file=sys.stderr)
-    print('Sorting temporary sample file by permuted index', file=sys.stderr)
-    srt_fn = os.path.join(args.temp_dir, '.reads.py.sorted')
-    srt_tmp_dir = os.path.join(args.temp_dir, 'sort_temp')
-    mkdir_quiet(srt_tmp_dir)
-    cmd = 'sort -n -k1,1 -S %dG -T %s %s > %s' % (args.sort_gb, srt_tmp_dir, unsrt_fn, srt_fn)
-    print(cmd, file=sys.stderr)
-    ret = os.system(cmd)
-    if ret != 0:
-        raise RuntimeError('sort command failed')
+    if args.jobs > 1 and len(gather_jobs) > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        try:
+            for job, crc in zip(gather_jobs, pool.imap(gather_bucket, gather_jobs, chunksize=1)):
+                _finish_sort(job, crc)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in gather_jobs:
+            _finish_sort(job, gather_bucket(job))
 
     if not args.keep_intermediates:
-        print('Deleting temporary sample file', file=sys.stderr)
-        os.remove(unsrt_fn)
+        print('Deleting unsorted buckets', file=sys.stderr)
+        for fn in bucket_fns:
+            if os.path.exists(fn):
+                os.remove(fn)
+        # sorted buckets are all there is to resume from now
+        manifest.finish('permute', [], bucket_size=bucket_size)
 
     print('*** Output ***', file=sys.stderr)
-    print('Preparing unblocked reads:', file=sys.stderr)
-    with open(srt_fn, 'rb') as fh:
-        with open(args.prefix + '_1.fq', 'wb') as ofh1:
-            with open(args.prefix + '_2.fq', 'wb') as ofh2:
-                n = 0
-                ival = 100
-                for ln in fh:
-                    toks = ln.rstrip().split('\t')
-                    assert toks[1][0] == '@'
-                    assert toks[3][0] == '+'
-                    assert toks[5][0] == '@'
-                    assert toks[7][0] == '+'
-                    ofh1.write(b'\n'.join(toks[1:5]) + b'\n')
-                    ofh2.write(b'\n'.join(toks[5:9]) + b'\n')
-                    if n == ival:
-                        ival = int(ival * ival_mult)
-                        print('  processed %d sorted records for unblocked output' % n, file=sys.stderr)
-                    n += 1
-
-    print('Preparing blocked reads:', file=sys.stderr)
-    with open(srt_fn, 'rb') as fh:
-        with open(args.prefix + '_block_1.fq', 'wb') as ofhb1:
-            with open(args.prefix + '_block_2.fq', 'wb') as ofhb2:
-                ival = 100
-                toks1, toks2 = [], []
-                nbytes1, nbytes2 = 0, 0
-                for i, ln in enumerate(fh):
-                    toks = ln.rstrip().split('\t')
-                    assert toks[1][0] == '@'
-                    assert toks[3][0] == '+'
-                    assert toks[5][0] == '@'
-                    assert toks[7][0] == '+'
-                    toks1.append(toks[1:5])
-                    toks2.append(toks[5:9])
-                    nbytes1 += sum(map(len, toks1[-1])) + 4
-                    nbytes2 += sum(map(len, toks2[-1])) + 4
-                    if (i+1) % reads_per_block == 0:
-                        toks1[-1][0] += b' ' * (block_sz - nbytes1)
-                        toks2[-1][0] += b' ' * (block_sz - nbytes2)
-                        for rec in toks1:
-                            ofhb1.write(b'\n'.join(rec) + b'\n')
-                        for rec in toks2:
-                            ofhb2.write(b'\n'.join(rec) + b'\n')
-                        toks1, toks2 = [], []
-                        nbytes1, nbytes2 = 0, 0
-                    if i == ival:
-                        ival = int(ival * ival_mult)
-                        print('  processed %d sorted records for blocked output' % i, file=sys.stderr)
-                if len(toks1) > 0:
-                    raise RuntimeError('Did not end on block boundary')
+    if output_state is not None and output_state.get('complete'):
+        print('Skipping output; already done', file=sys.stderr)
+    else:
+        def _checkpoint(state):
+            manifest.finish('output', [], **state)
+
+        if output_state is not None:
+            print('Resuming output after %d reads' % output_state['nreads'], file=sys.stderr)
+        print('Preparing unblocked and blocked reads:', file=sys.stderr)
+        writer = OutputWriter(args.prefix, block_sz, reads_per_block,
+                              resume=output_state, on_checkpoint=_checkpoint, pack=args.pack_blocks)
+        n = writer.nreads
+        ival = 100
+        for ln in sorted_lines(srt_fns, skip=writer.nreads):
+            writer.add(ln)
+            if n >= ival:
+                ival = int(ival * ival_mult)
+                print('  processed %d sorted records' % n, file=sys.stderr)
+            n += 1
+        writer.close()
+        out_fns = OutputWriter.output_fns(args.prefix)
+        idx_fns = [fastq.index_fn(fn) for fn in out_fns]
+        manifest.finish('output', out_fns + idx_fns, file_crcs=writer.crcs + [file_crc32(fn) for fn in idx_fns],
+                        nreads=writer.nreads, nblocks=writer.nblocks(), complete=True)
+        output_state = manifest.done('output')
+
+    if args.pack_blocks:
+        fixed_nblocks = (nreads + reads_per_block - 1) // reads_per_block
+        packed_nblocks = output_state['nblocks']
+        print('Packed %d reads into %d blocks (%0.2f reads/block); fixed layout with %d reads/block '
+              'needs %d blocks' % (nreads, packed_nblocks, float(nreads) / packed_nblocks,
+                                  reads_per_block, fixed_nblocks), file=sys.stderr)
+        print('Each blocked output is %d bytes instead of %d, saving %d bytes (%0.1f%%)' %
+              (packed_nblocks * block_sz, fixed_nblocks * block_sz, (fixed_nblocks - packed_nblocks) * block_sz,
+               100.0 * (fixed_nblocks - packed_nblocks) / fixed_nblocks), file=sys.stderr)
 
     if not args.keep_intermediates:
-        print('Deleting sorted sample file', file=sys.stderr)
-        os.remove(srt_fn)
+        print('Deleting sorted buckets', file=sys.stderr)
         shutil.rmtree(args.temp_dir)
 
 
@@ -317,16 +836,34 @@ if __name__ == '__main__':
                         help='max # bytes / read, for calculating # reads per block')
     parser.add_argument('--block-boundary', metavar='int', type=int, default=12288,
                         help='# characters constituting a single fixed-size block of FASTQ input')
+    parser.add_argument('--pack-blocks', action='store_const', const=True, default=False,
+                        help='Fit as many reads as possible into each blocked-output block, rather than '
+                             'block_boundary / max_read_size.  The # reads in each block is recorded in '
+                             'the .fqi index.')
     parser.add_argument('--seed', metavar='int', type=int, default=5744,
                         help='Pseudo-random seed.')
+    parser.add_argument('--jobs', metavar='int', type=int, default=1,
+                        help='Sample up to this many accessions at once in separate worker processes.  '
+                             'Output is the same as with --jobs 1.')
+    parser.add_argument('--decompress', metavar='mode', type=str, default='inline',
+                        choices=fastq.DECOMPRESS_MODES,
+                        help='How to decompress gzipped inputs: inline, in a background thread, or in a '
+                             '"gzip -dc" subprocess.  The latter two overlap decompression with sampling.')
+    parser.add_argument('--reservoir', metavar='mode', type=str, default='array', choices=sorted(reservoir_modes),
+                        help='"array" keeps just the ordinal of each sampled record and fetches survivors in a '
+                             'second pass; "text" writes every accepted record to a temporary file.')
     parser.add_argument('--sort-gb', metavar='int', type=int, default=3,
-                        help='GB of memory to allow sort to use.')
+                        help='GB of memory to allow the bucketed shuffle to use, across all --jobs.  Also bounds '
+                             'the write buffers of the bucket files while scattering.')
     parser.add_argument('--trim-to', metavar='int', type=int, default=9999,
                         help='If read is longer than this, trim to this length.')
     parser.add_argument('--keep-intermediates', action='store_const', const=True, default=False,
                         help='If set, intermediate files are not deleted.')
     parser.add_argument('--resume', action='store_const', const=True, default=False,
-                        help='Try to resume a job partway.')
+                        help='Resume an interrupted job, skipping the phases, accessions, buckets and '
+                             'output already recorded as finished in --temp-dir.')
+    parser.add_argument('--verify-resume', action='store_const', const=True, default=False,
+                        help='When resuming, check CRC-32s as well as sizes of finished intermediate files.')
     parser.add_argument('--prefix', metavar='str', type=str, default='out',
                         help='Prefix for output files.')
     parser.add_argument('--temp-dir', metavar='str', type=str, default='temp',
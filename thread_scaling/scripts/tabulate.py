@@ -142,7 +142,33 @@ def new_dat():
             'aligner': 'NA', 'series': 'NA', 'pe': 'NA',
             'threads_per_proc': 'NA', 'proc_id': 'NA',
             'totthreads': 'NA', 'attempt': 'NA',
-            'rd_load_time': 'NA'}
+            'rd_load_time': 'NA',
+            'wall_time': 'NA', 'wall_start': 'NA', 'wall_end': 'NA', 'wall_skew': 'NA',
+            'index_cache': 'NA', 'coscheduled': 'NA'}
+
+
+def parse_wall(fn, dat):
+    """ Parse per-process wall times written by master.py; start and end
+        are relative to the first process of the run to start, skew is the
+        spread of end times across the run's processes.  index_cache is
+        cold or warm if master.py set the index's page cache state. """
+    cols = {'wall': 'wall_time', 'start': 'wall_start', 'end': 'wall_end', 'skew': 'wall_skew'}
+    with open(fn) as ifh:
+        for ln in ifh:
+            key, val = ln.split(':')
+            if key in cols:
+                dat[cols[key]] = float(val)
+            elif key == 'index_cache':
+                dat['index_cache'] = val.strip()
+
+
+def parse_pack(fn, dat):
+    """ Parse the .pack file master.py --pack-runs writes; coscheduled is
+        the # other runs that overlapped this one on the same node """
+    with open(fn) as ifh:
+        for ln in ifh:
+            if ln.startswith('coscheduled:'):
+                dat['coscheduled'] = int(ln.split(':')[1])
 
 
 def tabulate():
@@ -214,6 +240,14 @@ def tabulate():
                                     dat['search_time'] = 0
                                 dat['search_time'] += float(ln.split()[3])
 
+                    fn_wall = fn[:-4] + '.wall'
+                    if os.path.exists(fn_wall):
+                        parse_wall(fn_wall, dat)
+
+                    fn_pack = fn[:-4] + '.pack'
+                    if os.path.exists(fn_pack):
+                        parse_pack(fn_pack, dat)
+
                     if aligner != 'bwa':
                         with open(fn_out) as iofh:
                             for ln in iofh:
@@ -0,0 +1,150 @@
+"""
+topology.py
+
+Reads the CPU topology (NUMA nodes, sockets, cores and SMT threads) from
+/sys/devices/system and assigns disjoint CPU sets to the aligner processes
+of a run, according to a pinning policy:
+
+  compact  fill one core's SMT threads, then the next core, then the next
+           socket, so each process's threads share as few cores as possible
+           with other processes
+  scatter  use one SMT thread on every core, round-robin across NUMA nodes,
+           before using any core's second SMT thread
+  numa     one process per NUMA node (round-robin if there are more
+           processes than nodes); each process's CPUs are packed compactly
+           within its node
+
+Only online CPUs that this process is allowed to run on are used.
+"""
+
+from __future__ import print_function
+import os
+import glob
+
+
+POLICIES = ['compact', 'scatter', 'numa']
+
+
+def parse_cpulist(st):
+    """ Parse a list like "0-3,8,10-11" into a list of ints """
+    ret = []
+    for tok in st.strip().split(','):
+        if len(tok) == 0:
+            continue
+        if '-' in tok:
+            lo, hi = tok.split('-')
+            ret.extend(range(int(lo), int(hi) + 1))
+        else:
+            ret.append(int(tok))
+    return ret
+
+
+def format_cpulist(cpus):
+    """ Inverse of parse_cpulist """
+    toks = []
+    cpus = sorted(cpus)
+    i = 0
+    while i < len(cpus):
+        j = i
+        while j + 1 < len(cpus) and cpus[j+1] == cpus[j] + 1:
+            j += 1
+        toks.append(str(cpus[i]) if i == j else '%d-%d' % (cpus[i], cpus[j]))
+        i = j + 1
+    return ','.join(toks)
+
+
+def _read(fn):
+    with open(fn) as fh:
+        return fh.read().strip()
+
+
+class Cpu(object):
+    def __init__(self, cpu, node, package, core, smt):
+        self.cpu, self.node, self.package, self.core, self.smt = cpu, node, package, core, smt
+
+    def __repr__(self):
+        return 'Cpu(%d, node=%d, package=%d, core=%d, smt=%d)' % (self.cpu, self.node, self.package,
+                                                                  self.core, self.smt)
+
+
+def read_topology(root='/sys/devices/system', allowed=None):
+    """ Return a Cpu for each online CPU in allowed (default: the CPUs this
+        process may run on) """
+    if allowed is None:
+        allowed = os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else None
+    online = parse_cpulist(_read(os.path.join(root, 'cpu', 'online')))
+    node_of = {}
+    for node_dir in glob.glob(os.path.join(root, 'node', 'node[0-9]*')):
+        node = int(os.path.basename(node_dir)[4:])
+        for cpu in parse_cpulist(_read(os.path.join(node_dir, 'cpulist'))):
+            node_of[cpu] = node
+    cpus = []
+    for cpu in online:
+        if allowed is not None and cpu not in allowed:
+            continue
+        topo = os.path.join(root, 'cpu', 'cpu%d' % cpu, 'topology')
+        package = int(_read(os.path.join(topo, 'physical_package_id')))
+        core = int(_read(os.path.join(topo, 'core_id')))
+        siblings = parse_cpulist(_read(os.path.join(topo, 'thread_siblings_list')))
+        cpus.append(Cpu(cpu, node_of.get(cpu, 0), package, core, sorted(siblings).index(cpu)))
+    if len(cpus) == 0:
+        raise RuntimeError('No usable CPUs found under "%s"' % root)
+    return cpus
+
+
+def compact_order(cpus):
+    return sorted(cpus, key=lambda c: (c.node, c.package, c.core, c.smt, c.cpu))
+
+
+def scatter_order(cpus):
+    """ SMT thread 0 of every core first, cores taken round-robin across
+        NUMA nodes, then SMT thread 1 of every core, and so on """
+    ret = []
+    for smt in sorted(set(c.smt for c in cpus)):
+        by_node = {}
+        for c in compact_order([c for c in cpus if c.smt == smt]):
+            by_node.setdefault(c.node, []).append(c)
+        queues = [by_node[node] for node in sorted(by_node)]
+        while any(queues):
+            for q in queues:
+                if len(q) > 0:
+                    ret.append(q.pop(0))
+    return ret
+
+
+def assign(cpus, policy, nprocess, threads_per_process):
+    """ Return a list of nprocess disjoint lists of Cpus, each with
+        threads_per_process Cpus, chosen according to policy """
+    if policy not in POLICIES:
+        raise RuntimeError('Unknown pinning policy: "%s"' % policy)
+    need = nprocess * threads_per_process
+    if need > len(cpus):
+        raise RuntimeError('Pinning %d processes x %d threads needs %d CPUs, but only %d are available' %
+                           (nprocess, threads_per_process, need, len(cpus)))
+    if policy in ['compact', 'scatter']:
+        order = compact_order(cpus) if policy == 'compact' else scatter_order(cpus)
+        return [order[i * threads_per_process:(i+1) * threads_per_process] for i in range(nprocess)]
+    nodes = sorted(set(c.node for c in cpus))
+    node_cpus = dict((node, compact_order([c for c in cpus if c.node == node])) for node in nodes)
+    ret = []
+    for i in range(nprocess):
+        node = nodes[i % len(nodes)]
+        avail = node_cpus[node]
+        if len(avail) < threads_per_process:
+            raise RuntimeError('NUMA node %d has too few CPUs left for process %d (%d threads)' %
+                               (node, i, threads_per_process))
+        ret.append(avail[:threads_per_process])
+        node_cpus[node] = avail[threads_per_process:]
+    return ret
+
+
+def write_mapping(ofn, policy, assignment):
+    """ Record which CPUs (and which nodes, sockets and cores) each process
+        was pinned to """
+    with open(ofn, 'w') as fh:
+        fh.write('\t'.join(['process', 'policy', 'cpus', 'nodes', 'packages', 'ncores']) + '\n')
+        for i, cpus in enumerate(assignment):
+            fh.write('\t'.join(map(str, [i, policy, format_cpulist(c.cpu for c in cpus),
+                                         format_cpulist(set(c.node for c in cpus)),
+                                         format_cpulist(set(c.package for c in cpus)),
+                                         len(set((c.package, c.core) for c in cpus))])) + '\n')